@@ -7,3 +7,10 @@ app = Celery("datacore")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
+app.conf.beat_schedule = {
+    'reconcile-record-counts': {
+        'task': 'tsepamo.tasks.reconcile_record_counts_task',
+        'schedule': crontab(minute=0),
+    },
+}
+
@@ -228,4 +228,20 @@ CELERY_TIMEZONE = 'Africa/Gaborone'
 CELERY_BROKER_URL = "redis://localhost:6379"
 CELERY_RESULT_BACKEND = "redis://localhost:6379"
 
+# Export downloads, set to 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache)
+# to have the front proxy send export files instead of Django.
+EXPORT_DOWNLOAD_MODE = None
+EXPORT_ACCEL_REDIRECT_PREFIX = '/protected/documents/'
+
+# Compression levels for csv.gz (1-9) and csv.zst (1-22) exports
+EXPORT_COMPRESSION_LEVELS = {'gz': 6, 'zst': 3}
+
+# Cache, holds the record count statistics shown on the dashboard
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+    }
+}
+
 CSRF_TRUSTED_ORIGINS = ['https://127.0.0.1', 'https://localhost']
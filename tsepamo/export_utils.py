@@ -1,20 +1,33 @@
+import csv
+import gzip
 import os
 import datetime
+import heapq
 import pandas as pd
 from bson.decimal128 import Decimal128
 from celery import shared_task, group, chain
 from celery.exceptions import SoftTimeLimitExceeded
-from collections import defaultdict
 from django.core.mail import EmailMessage
 from django.apps import apps as django_apps
 from django.conf import settings
 from django.http.response import HttpResponse, JsonResponse
 from io import BytesIO
+from itertools import groupby
+from operator import itemgetter
 
 from .models import ExportFile
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 upload_folder = settings.MEDIA_ROOT
 
+# Compressed CSV export types, mapped to their compression.
+CSV_COMPRESSIONS = {'csv.gz': 'gz', 'csv.zst': 'zst'}
+DEFAULT_COMPRESSION_LEVELS = {'gz': 6, 'zst': 3}
+
 
 class GenerateDataExports:
     """ Generate data to different file formats, with either a select subset
@@ -71,31 +84,14 @@ class GenerateDataExports:
 @shared_task(bind=True, soft_time_limit=7000, time_limit=7200)
 def prepare_export_data_task(self, app_label, model_names, export_fields,
                              export_type, export_name, user_emails, export_id):
-    data = defaultdict(dict)
     try:
-        chunk_size = 10000
-        for model_name in model_names:
-            model_cls = django_apps.get_model(app_label, model_name)
-            offset = 0
-            while True:
-                records = fetch_model_data(model_cls, export_fields, offset, chunk_size)
-                if not records:
-                    break
-                for record in records:
-                    record_id = record.pop('record_id')
-                    print(record_id)
-                    data[record_id].update(record)
-                offset += chunk_size
-
-        merged_data = []
-        for record_id, record_data in data.items():
-            print(record_id)
-            merged_data.append(
-                {'record_id': record_id, **record_data})
-
-        if export_type.lower() == 'csv':
-            write_to_csv(merged_data, export_name, user_emails, export_id)
+        if export_type.lower() == 'csv' or export_type.lower() in CSV_COMPRESSIONS:
+            stream_to_csv(app_label, model_names, export_fields, export_id,
+                          compression=CSV_COMPRESSIONS.get(export_type.lower()))
+            send_email_task.delay(export_name, user_emails, export_id)
         if export_type.lower() == 'excel':
+            merged_data = list(
+                iter_merged_records(app_label, model_names, export_fields))
             write_to_excel_task(merged_data, export_name, user_emails, export_id)
     except SoftTimeLimitExceeded:
         self.update_state(state='FAILURE')
@@ -113,6 +109,113 @@ def get_unique_record_ids(app_label, model_names):
     return unique_record_ids
 
 
+def iter_merged_records(app_label, model_names, export_fields, chunk_size=2000):
+    """ Yields one merged record per `record_id` across the selected models.
+        Each model is read in `record_id` order and the streams are merged
+        row by row, so only the current record is held in memory.
+        @param app_label: app label for the models
+        @param model_names: models to merge, later models take precedence on
+                            duplicate field names
+        @param export_fields: subset fields of interest.
+        @param chunk_size: number of rows fetched per database round trip
+    """
+    streams = []
+    for model_name in model_names:
+        model_cls = django_apps.get_model(app_label, model_name)
+        streams.append(iter_model_data(model_cls, export_fields, chunk_size))
+
+    merged = heapq.merge(*streams, key=itemgetter('record_id'))
+    for record_id, records in groupby(merged, key=itemgetter('record_id')):
+        merged_record = {'record_id': record_id}
+        for record in records:
+            merged_record.update(record)
+        yield merged_record
+
+
+def get_export_columns(app_label, model_names, export_fields):
+    """ Returns the ordered union of export columns for the selected models,
+        with `record_id` first.
+    """
+    columns = {'record_id': None}
+    for model_name in model_names:
+        model_cls = django_apps.get_model(app_label, model_name)
+        columns.update(
+            dict.fromkeys(get_model_related_fields(model_cls, export_fields)))
+    return list(columns)
+
+
+class CountingTextWriter:
+    """ Encodes text written by the csv writer to a binary, possibly
+        compressing, stream and counts the uncompressed bytes.
+    """
+
+    def __init__(self, stream, encoding='utf-8'):
+        self.stream = stream
+        self.encoding = encoding
+        self.bytes_written = 0
+
+    def write(self, text):
+        data = text.encode(self.encoding)
+        self.bytes_written += len(data)
+        return self.stream.write(data)
+
+
+def get_compression_level(compression, level=None):
+    if level is not None:
+        return level
+    levels = getattr(settings, 'EXPORT_COMPRESSION_LEVELS', {})
+    return levels.get(compression, DEFAULT_COMPRESSION_LEVELS[compression])
+
+
+def open_export_stream(file_path, compression=None, level=None):
+    """ Opens a binary stream for an export file, compressing on the fly
+        for `gz` (gzip) and `zst` (zstandard) so the uncompressed export is
+        never written to disk.
+    """
+    if compression == 'gz':
+        return gzip.open(file_path, 'wb', compresslevel=get_compression_level('gz', level))
+    if compression == 'zst':
+        if zstandard is None:
+            raise ValueError('csv.zst exports require the zstandard package.')
+        compressor = zstandard.ZstdCompressor(level=get_compression_level('zst', level))
+        return compressor.stream_writer(open(file_path, 'wb'))
+    if compression:
+        raise ValueError(f'Unsupported export compression: {compression}')
+    return open(file_path, 'wb')
+
+
+def stream_to_csv(app_label, model_names, export_fields, export_id, compression=None,
+                  compression_level=None):
+    """ Write merged model data straight to the export file, one row at a
+        time. The file is written to a temporary path first and renamed on
+        completion, so a partial export is never served for download.
+        @param compression: `gz` or `zst` to compress while writing
+        @param compression_level: overrides `EXPORT_COMPRESSION_LEVELS`
+    """
+    export_file = ExportFile.objects.get(id=export_id)
+    file_path = os.path.join(settings.MEDIA_ROOT, export_file.file.name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+    columns = get_export_columns(app_label, model_names, export_fields)
+    records = iter_merged_records(app_label, model_names, export_fields)
+
+    temp_path = f'{file_path}.part'
+    try:
+        with open_export_stream(temp_path, compression, compression_level) as stream:
+            file = CountingTextWriter(stream)
+            writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+        os.replace(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    export_file.uncompressed_size = file.bytes_written
+    export_file.save()
+    return file_path
+
+
 def write_to_csv(records: list, export_name, user_emails, export_id):
     """ Write data to csv format and returns response
     """
@@ -167,6 +270,31 @@ def fetch_model_data(model_cls, export_fields, offset=0, limit=10000):
     return list(model_cls.objects.values(*model_fields)[offset:offset + limit])
 
 
+def iter_model_data(model_cls, export_fields, chunk_size=10000):
+    """ Yields model records in `record_id` order, paging on
+        `record_id > last_seen` over the unique `record_id` index rather
+        than OFFSET slicing, so every page costs the same to fetch.
+        @param model_cls: model class
+        @param export_fields: subset fields of interest.
+        @param chunk_size: number of records fetched per page
+    """
+    model_fields = get_model_related_fields(model_cls, export_fields)
+    if 'record_id' not in model_fields:
+        model_fields = ['record_id', *model_fields]
+    queryset = model_cls.objects.order_by('record_id').values(*model_fields)
+
+    last_record_id = None
+    while True:
+        page = queryset
+        if last_record_id is not None:
+            page = queryset.filter(record_id__gt=last_record_id)
+        records = list(page[:chunk_size])
+        yield from records
+        if len(records) < chunk_size:
+            break
+        last_record_id = records[-1]['record_id']
+
+
 @shared_task
 def send_email_task(export_name, user_emails, export_id):
     email = EmailMessage('DataCore export ready',
@@ -186,6 +314,9 @@ def send_email_task(export_name, user_emails, export_id):
     else:
         export_file.datetime_completed = datetime.datetime.now()
         export_file.download_complete = True
+        file_path = os.path.join(upload_folder, export_file.file.name)
+        if os.path.exists(file_path):
+            export_file.file_size = os.path.getsize(file_path)
         export_file.save()
 
 
@@ -0,0 +1,94 @@
+from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
+from bson.decimal128 import Decimal128
+from django.db.models import (DateTimeField, DateField, IntegerField,
+                              DecimalField)
+
+DATETIME_FORMATS = ('%Y-%m-%d %H:%M', '%Y-%d-%m %H:%M')
+DATE_FORMATS = ('%Y-%m-%d', '%Y-%d-%m')
+
+
+@lru_cache(maxsize=8192)
+def parse_datetime(value, formats=DATETIME_FORMATS):
+    """ Parses a date/time string against each format in turn, caching
+        results since REDCap exports repeat the same dates many times.
+        Raises ValueError when no format matches.
+    """
+    for date_format in formats[:-1]:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return datetime.strptime(value, formats[-1])
+
+
+def convert_datetime(value):
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    return parse_datetime(value, DATETIME_FORMATS)
+
+
+def convert_date(value):
+    if value is None or value == '':
+        return None
+    if not isinstance(value, str):
+        return value
+    return parse_datetime(value, DATE_FORMATS).date()
+
+
+def convert_integer(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def convert_decimal(value):
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    if value is None or value == '':
+        return None
+    return Decimal(value)
+
+
+def convert_default(value):
+    return None if value == '' else value
+
+
+# Checked in order, so subclasses (DateTimeField) come before their parents.
+FIELD_CONVERTERS = [(DateTimeField, convert_datetime),
+                    (DateField, convert_date),
+                    (IntegerField, convert_integer),
+                    (DecimalField, convert_decimal)]
+
+
+def get_field_converter(field):
+    """ Returns the converter for a model field instance.
+    """
+    for field_cls, converter in FIELD_CONVERTERS:
+        if isinstance(field, field_cls):
+            return converter
+    return convert_default
+
+
+@lru_cache(maxsize=None)
+def get_model_converters(model_cls, exclude_fields=('id', 'record_id')):
+    """ Builds the {field_name: converter} map for a model once, so rows are
+        formatted without resolving field types per value.
+        @param model_cls: model class
+        @param exclude_fields: fields left out of the formatted record
+        @return: dict of field name to converter function
+    """
+    return {field.name: get_field_converter(field)
+            for field in model_cls._meta.fields
+            if field.name not in exclude_fields}
+
+
+def format_record(converters, record):
+    """ Applies compiled converters to a record, fields missing from the
+        record are formatted as None.
+    """
+    return {field_name: converter(record.get(field_name))
+            for field_name, converter in converters.items()}
@@ -0,0 +1,93 @@
+import hashlib
+import os
+import tempfile
+from django.conf import settings
+
+FILE_INDEX_COLLECTION = 'redcap_files'
+
+# Temporary files are created 0600, blobs get the mode a plain open() would.
+_umask = os.umask(0)
+os.umask(_umask)
+FILE_MODE = 0o666 & ~_umask
+
+# Leading bytes of the file types REDCap projects hold, checked in order.
+FILE_SIGNATURES = [(b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+                   (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+                   (b'GIF87a', 'gif', 'image/gif'),
+                   (b'GIF89a', 'gif', 'image/gif'),
+                   (b'%PDF', 'pdf', 'application/pdf'),
+                   (b'II*\x00', 'tif', 'image/tiff'),
+                   (b'MM\x00*', 'tif', 'image/tiff'),
+                   (b'PK\x03\x04', 'zip', 'application/zip')]
+
+
+def sniff_file_type(content):
+    """ Works out a file's type from its leading bytes rather than trusting
+        a name or an assumed extension.
+        @return: (extension, content type)
+    """
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'webp', 'image/webp'
+    for signature, extension, content_type in FILE_SIGNATURES:
+        if content.startswith(signature):
+            return extension, content_type
+    return 'bin', 'application/octet-stream'
+
+
+class ContentAddressedFileStore:
+    """ Stores REDCap file field blobs once each, named by their sha256 and
+        sharded into nested directories (`ab/cd/abcd....jpg`) so no single
+        directory grows large. A Mongo index maps each (record_id, field)
+        to the blob it currently points at.
+    """
+
+    def __init__(self, db, root=None):
+        self.root = root or os.path.join(settings.MEDIA_ROOT, 'redcap_files')
+        self.index = db[FILE_INDEX_COLLECTION]
+        self.index.create_index([('references.record_id', 1),
+                                 ('references.field_name', 1)])
+
+    def blob_path(self, content_hash, extension):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4],
+                            f'{content_hash}.{extension}')
+
+    def put(self, content, record_id, field_name):
+        """ Stores a blob unless it is already held and points the record's
+            field at it. New blobs are written to a temporary file renamed
+            into place, so readers never see a partial file.
+            @return: (file path, content hash)
+        """
+        content_hash = hashlib.sha256(content).hexdigest()
+        extension, content_type = sniff_file_type(content)
+        file_path = self.blob_path(content_hash, extension)
+
+        if not os.path.exists(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            temp_file = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(file_path), delete=False)
+            try:
+                with temp_file:
+                    temp_file.write(content)
+                os.chmod(temp_file.name, FILE_MODE)
+                os.replace(temp_file.name, file_path)
+            finally:
+                if os.path.exists(temp_file.name):
+                    os.remove(temp_file.name)
+
+        reference = {'record_id': record_id, 'field_name': field_name}
+        self.index.update_many(
+            {'references': reference, '_id': {'$ne': content_hash}},
+            {'$pull': {'references': reference}})
+        self.index.update_one(
+            {'_id': content_hash},
+            {'$set': {'path': file_path, 'content_type': content_type,
+                      'size': len(content)},
+             '$addToSet': {'references': reference}},
+            upsert=True)
+        return file_path, content_hash
+
+    def lookup(self, record_id, field_name):
+        """ @return: index entry of the blob a record's field points at, or None
+        """
+        return self.index.find_one(
+            {'references': {'record_id': record_id, 'field_name': field_name}})
@@ -0,0 +1,70 @@
+import time
+
+from django.apps import apps as django_apps
+from django.core.management.base import BaseCommand
+from django.db.models import (DateTimeField, DateField, IntegerField,
+                              DecimalField)
+
+from tsepamo.field_converters import format_record, get_model_converters
+from tsepamo.utils import LoadCSVData
+
+
+class Command(BaseCommand):
+    help = ('Time per-value format_fields dispatch against precompiled model '
+            'converters over a full-width model row')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model',
+                            type=str,
+                            default='tsepamo.tsepamothree',
+                            help='Model to format rows for, as app_label.model_name')
+
+        parser.add_argument('--iterations',
+                            type=int,
+                            default=1000,
+                            help='Number of rows formatted per run')
+
+    def handle(self, *args, **options):
+        model_cls = django_apps.get_model(options['model'])
+        iterations = options['iterations']
+        row = self.sample_row(model_cls)
+
+        loader = LoadCSVData()
+        model_fields = [field for field in model_cls._meta.fields
+                        if field.name not in ['id', 'record_id']]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            {field.name: loader.format_fields(field, row.get(field.name))
+             for field in model_fields}
+        per_value_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        converters = get_model_converters(model_cls)
+        for _ in range(iterations):
+            format_record(converters, row)
+        compiled_time = time.perf_counter() - start
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{model_cls._meta.label}, {len(model_fields)} fields x {iterations} rows: '
+            f'format_fields {per_value_time:.3f}s, compiled {compiled_time:.3f}s '
+            f'({per_value_time / compiled_time if compiled_time else 0:.1f}x)'))
+
+    def sample_row(self, model_cls):
+        """ Builds a REDCap-like row, where most cells are blank as in the
+            wide Tsepamo exports.
+        """
+        row = {}
+        for index, field in enumerate(model_cls._meta.fields):
+            if index % 3:
+                row[field.name] = ''
+            elif isinstance(field, DateTimeField):
+                row[field.name] = '2021-03-04 10:15'
+            elif isinstance(field, DateField):
+                row[field.name] = '2021-03-04'
+            elif isinstance(field, IntegerField):
+                row[field.name] = '12'
+            elif isinstance(field, DecimalField):
+                row[field.name] = '3.5'
+            else:
+                row[field.name] = '1'
+        return row
@@ -0,0 +1,64 @@
+import time
+
+from django.apps import apps as django_apps
+from django.core.management.base import BaseCommand, CommandError
+
+from tsepamo.export_utils import fetch_model_data, iter_model_data
+
+
+class Command(BaseCommand):
+    help = ('Compare OFFSET paging (fetch_model_data) against record_id keyset '
+            'paging (iter_model_data) over the first N records of a model')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model',
+                            type=str,
+                            default='tsepamo.tsepamofour',
+                            help='Model to read, as app_label.model_name')
+
+        parser.add_argument('--sizes',
+                            type=int,
+                            nargs='+',
+                            default=[10000, 100000, 500000],
+                            help='Number of records to read per run')
+
+        parser.add_argument('--chunk_size',
+                            type=int,
+                            default=10000,
+                            help='Records fetched per page')
+
+    def handle(self, *args, **options):
+        try:
+            model_cls = django_apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(f'Invalid model {options["model"]}: {e}')
+
+        chunk_size = options['chunk_size']
+        total_count = model_cls.objects.count()
+
+        for size in options['sizes']:
+            if size > total_count:
+                self.stdout.write(self.style.WARNING(
+                    f'Skipping {size} records, {model_cls._meta.label} '
+                    f'only has {total_count}.'))
+                continue
+
+            offset_time = self.time_offset_fetch(model_cls, size, chunk_size)
+            keyset_time = self.time_keyset_fetch(model_cls, size, chunk_size)
+            self.stdout.write(self.style.SUCCESS(
+                f'{size} records: offset {offset_time:.2f}s, '
+                f'keyset {keyset_time:.2f}s '
+                f'({offset_time / keyset_time if keyset_time else 0:.1f}x)'))
+
+    def time_offset_fetch(self, model_cls, size, chunk_size):
+        start = time.perf_counter()
+        for offset in range(0, size, chunk_size):
+            fetch_model_data(model_cls, [], offset, min(chunk_size, size - offset))
+        return time.perf_counter() - start
+
+    def time_keyset_fetch(self, model_cls, size, chunk_size):
+        start = time.perf_counter()
+        for count, _ in enumerate(iter_model_data(model_cls, [], chunk_size), 1):
+            if count >= size:
+                break
+        return time.perf_counter() - start
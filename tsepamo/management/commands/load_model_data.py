@@ -5,9 +5,20 @@ from tsepamo.tasks import run_load_model_data_task
 class Command(BaseCommand):
     help = 'Load model data'
 
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=1000,
+                            help='Number of records created per bulk insert')
 
-        run_load_model_data_task.delay()
+        parser.add_argument('--update_existing',
+                            action='store_true',
+                            help='Update records that already exist')
+
+    def handle(self, *args, **options):
+
+        run_load_model_data_task.delay(
+            options['batch_size'], options['update_existing'])
 
         self.stdout.write(self.style.SUCCESS(
             f'Tsepamo data successfully loaded.'))
@@ -1,98 +1,81 @@
+from django.apps import apps as django_apps
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.forms.models import model_to_dict
-from tsepamo.utils import LoadCSVData
-
-from tsepamo.models import (
-    TsepamoOne, TsepamoTwo, TsepamoThree, TsepamoFour,
-    OutcomesOne, OutcomesTwo, OutcomesThree, OutcomesFour,
-    PersonalIdentifiersTwo, PersonalIdentifiersThree, PersonalIdentifiersFour,
-    SwitcherIpmsFour, SwitcherIPMSThree, SwitcherIpmsTwo,
-    Tsepamo, Outcomes, PersonalIdentifiers, SwitcherIpms
-)
+from tsepamo.migration_utils import MIGRATION_JOBS, ModelMigration
+from tsepamo.tasks import get_mongo_client, run_data_migration_task
 
 
 class Command(BaseCommand):
     help = 'Migrate data from old models to new models'
 
-    def handle(self, *args, **kwargs):
-        self.tsepamo_data = LoadCSVData()
-        self.migrate_tsepamo()
-        self.migrate_outcomes()
-        self.migrate_personal_identifiers()
-        self.migrate_switcher_ipms()
-        self.stdout.write(self.style.SUCCESS(
-            f'Data migration completed successfully'))
+    def add_arguments(self, parser):
+        parser.add_argument('--batch_size',
+                            type=int,
+                            default=1000,
+                            help='Number of rows per bulk insert')
+
+        parser.add_argument('--chunk_size',
+                            type=int,
+                            default=2000,
+                            help='Number of source rows fetched per query')
 
-    def migrate_tsepamo(self):
-        field_mapping = {
-            'placental_organism': 'placenta_organism',
-            'placental_pcdecid': 'placenta_pcdecid',
-            'placental_avascvilli': 'placenta_avascvilli',
-            'placental_distalvh': 'placenta_distalvh',
-            'placental_fetalmalp': 'placenta_fetalmalp',
-            'was_this_woman_on_aspirin': 'was_this_woman_aspirin',
-            # add all relevant field mappings here
-        }
-        self.migrate_model(
-            [TsepamoOne, TsepamoTwo, TsepamoThree,TsepamoFour], Tsepamo, field_mapping)
+        parser.add_argument('--target_models',
+                            nargs='+',
+                            type=str,
+                            help='Only migrate into these models, e.g. tsepamo.outcomes')
 
-    def migrate_outcomes(self):
-        field_mapping ={
-            'surgery_describe':'surgery_details',
-            'ipms_followup':'imps_followup'
-        }
-        self.migrate_model(
-            [OutcomesOne, OutcomesTwo, OutcomesThree,OutcomesFour], Outcomes,field_mapping)
-        
+        parser.add_argument('--parallel',
+                            action='store_true',
+                            help='Run each target model as Celery tasks in parallel')
 
-    def migrate_personal_identifiers(self):
-        self.migrate_model([PersonalIdentifiersTwo, PersonalIdentifiersThree,
-                           PersonalIdentifiersFour], PersonalIdentifiers)
+        parser.add_argument('--restart',
+                            action='store_true',
+                            help='Ignore saved checkpoints and read sources from the start')
 
-    def migrate_switcher_ipms(self):
-        self.migrate_model(
-            [SwitcherIpmsTwo, SwitcherIPMSThree, SwitcherIpmsFour], SwitcherIpms)
+    def handle(self, *args, **kwargs):
+        self.batch_size = kwargs.get('batch_size', 1000)
+        self.chunk_size = kwargs.get('chunk_size', 2000)
+        target_models = kwargs.get('target_models')
+        self.db = get_mongo_client()[settings.MONGO_DB_NAME]
 
-    def migrate_model(self, old_models, new_model, field_mapping=None):
-        print(new_model, old_models)
-        for old_model in old_models:
-            for obj in old_model.objects.all():
-                data = model_to_dict(obj)
-                # Remove the primary key to avoid conflicts
-                data.pop('id', None)
+        jobs = {target_model: source_models
+                for target_model, source_models in MIGRATION_JOBS.items()
+                if not target_models or target_model in target_models}
 
-                if field_mapping:
-                    transformed_data = {field_mapping.get(
-                        k, k): v for k, v in data.items()}
-                    if transformed_data:
-                        self.format_all_fields(new_model, transformed_data)
-                        try:
-                            self.get_or_create_model_obj(new_model, transformed_data)
-                        except Exception:
-                            print(f"Error for, {transformed_data.get('record_id')}")
-                else:
-                    self.format_all_fields(new_model, data)
-                    try:
-                        self.get_or_create_model_obj(new_model, data)
-                    except Exception:
-                        print(f"Error for, {data.get('record_id')}")
+        if kwargs.get('restart'):
+            for target_model, source_models in jobs.items():
+                for source_model in source_models:
+                    self.get_migration(source_model, target_model).clear_checkpoint()
 
-    def get_or_create_model_obj(self, model_cls, data={}):
-        try:
-            model_cls.objects.get(record_id=data.get('record_id', None))
-        except model_cls.DoesNotExist:
-            print('Migrated Record', data.get('record_id'))
-            model_cls.objects.create(**data)
+        if kwargs.get('parallel'):
+            run_data_migration_task.delay(self.batch_size, self.chunk_size, list(jobs))
+            self.stdout.write(self.style.SUCCESS(
+                f'Data migration started for {", ".join(jobs)}'))
+            return
 
-    def format_all_fields(self, model, data):
-        model_fields = {field.name: field for field in model._meta.fields}
-        formatted_data = {}
+        for target_model, source_models in jobs.items():
+            for source_model in source_models:
+                self.migrate_model(source_model, target_model)
+        self.stdout.write(self.style.SUCCESS(
+            f'Data migration completed successfully'))
 
-        for field_name, field in model_fields.items():
-            value = data.get(field_name)
-            if field_name == 'record_id':
-                continue
-            formatted_data[field_name] = self.tsepamo_data.format_fields(
-                field, value)
+    def get_migration(self, source_model, target_model):
+        return ModelMigration(
+            django_apps.get_model(source_model), django_apps.get_model(target_model),
+            batch_size=self.batch_size, chunk_size=self.chunk_size,
+            progress=self.write_progress, db=self.db)
+
+    def migrate_model(self, source_model, target_model):
+        stats = self.get_migration(source_model, target_model).run()
+        self.stdout.write(self.style.SUCCESS(
+            f"Migrated {stats['source']} to {stats['target']}: {stats['created']} "
+            f"created from {stats['rows']} rows, {stats['errors']} errors "
+            f"in {stats['seconds']}s"))
+        if stats['errors']:
+            self.stdout.write(self.style.WARNING(
+                f"Failed rows are in the data_migration_errors collection"))
 
-        data.update(formatted_data)
+    def write_progress(self, stats):
+        self.stdout.write(
+            f"{stats['source']}: {stats['rows']} rows, {stats['created']} created "
+            f"({stats['rows_per_second']} rows/s)")
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 
-from tsepamo.tasks import export_project_data_and_send_email
+from tsepamo.tasks import export_project_data_and_send_email, sync_redcap_projects_task
 
 
 project_models_map = {'tsepamo_1': 'tsepamo',
@@ -25,18 +25,65 @@ class Command(BaseCommand):
                             required=True,
                             help='Email address of registered users')
 
+        parser.add_argument('--incremental',
+                            action='store_true',
+                            help='Only pull records created or edited since the last sync')
+
+        parser.add_argument('--download_workers',
+                            type=int,
+                            default=8,
+                            help='Number of concurrent file field downloads')
+
+        parser.add_argument('--forms',
+                            nargs='+',
+                            type=str,
+                            help='Only pull these REDCap instruments')
+
+        parser.add_argument('--fields',
+                            nargs='+',
+                            type=str,
+                            help='Only pull these REDCap fields')
+
+        parser.add_argument('--shards',
+                            type=int,
+                            help='Split each project into this many record ranges '
+                                 'synced in parallel, with one summary email')
+
+        parser.add_argument('--max_concurrency',
+                            type=int,
+                            default=2,
+                            help='Most shards using one REDCap token at a time')
+
     def handle(self, *args, **options):
         project_names = options.get('project_names', None)
         if not project_names:
             project_names = project_models_map.keys()
         emails = options['emails']
+        incremental = options['incremental']
+        download_workers = options['download_workers']
+        forms = options['forms']
+        fields = options['fields']
+
+        if options['shards']:
+            if forms or fields:
+                raise CommandError('--forms and --fields cannot be used with --shards.')
+            project_names = [project_name for project_name in project_models_map
+                             if project_name in project_names]
+            sync_redcap_projects_task.delay(
+                project_names, emails, 'tsepamo', incremental, options['shards'],
+                options['max_concurrency'], download_workers)
+            self.stdout.write(
+                self.style.SUCCESS(f'Tsepamo sharded sync started for {", ".join(project_names)}'))
+            return
 
         for project_name, models in project_models_map.items():
             if project_name not in project_names:
                 continue
 
             try:
-                export_project_data_and_send_email.delay(project_name, emails, models)
+                export_project_data_and_send_email.delay(
+                    project_name, emails, models, incremental, download_workers,
+                    forms, fields)
             except Exception as e:
                 raise CommandError(
                     f'Failed to pull data for {project_name} with {e}, check logs.')
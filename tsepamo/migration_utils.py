@@ -0,0 +1,188 @@
+import logging
+import time
+from decimal import InvalidOperation
+from django.utils import timezone
+from .record_stats import increment_record_count
+from .schema_mapping import get_schema_mapping
+from .utils import BulkModelLoader
+
+logger = logging.getLogger('celery_progress')
+
+MIGRATION_STATE_COLLECTION = 'data_migration_state'
+MIGRATION_ERRORS_COLLECTION = 'data_migration_errors'
+
+# Legacy models consolidated into each target model, migrated in this order.
+MIGRATION_JOBS = {
+    'tsepamo.tsepamo': ['tsepamo.tsepamoone', 'tsepamo.tsepamotwo',
+                        'tsepamo.tsepamothree', 'tsepamo.tsepamofour'],
+    'tsepamo.outcomes': ['tsepamo.outcomesone', 'tsepamo.outcomestwo',
+                         'tsepamo.outcomesthree', 'tsepamo.outcomesfour'],
+    'tsepamo.personalidentifiers': ['tsepamo.personalidentifierstwo',
+                                    'tsepamo.personalidentifiersthree',
+                                    'tsepamo.personalidentifiersfour'],
+    'tsepamo.switcheripms': ['tsepamo.switcheripmstwo', 'tsepamo.switcheripmsthree',
+                             'tsepamo.switcheripmsfour'],
+}
+
+
+class MigrationLoader(BulkModelLoader):
+    """ Bulk loader that falls back to row by row inserts when a batch
+        fails, so one bad row costs its own insert rather than the batch.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = []
+
+    def flush(self):
+        try:
+            super().flush()
+        except Exception:
+            pending, self.pending = self.pending, []
+            inserted = set(self.model_cls.objects.filter(
+                record_id__in=[obj.record_id for obj in pending]).values_list(
+                    'record_id', flat=True))
+            self.created += len(inserted)
+            for obj in pending:
+                if obj.record_id in inserted:
+                    continue
+                try:
+                    obj.save(force_insert=True)
+                except Exception as e:
+                    self.errors.append((obj.record_id, str(e)))
+                else:
+                    self.created += 1
+
+
+class ModelMigration:
+    """ Copies one legacy model into its consolidated model. Source rows
+        are streamed in record id order with `.values().iterator()`, mapped
+        with the target's schema mapping and inserted with `bulk_create`,
+        records already in the target are skipped without a query per row.
+
+        Given a MongoDB `db`, the last migrated record id is checkpointed
+        every `progress_every` rows so a crashed job resumes after it, and
+        rows that fail are kept in the `data_migration_errors` collection
+        for review.
+    """
+
+    def __init__(self, source_model, target_model, batch_size=1000, chunk_size=2000,
+                 progress_every=10000, progress=None, db=None, run_id=None):
+        """
+        @param progress_every: rows between progress reports and checkpoints
+        @param progress: callable given the stats dict on each report
+        @param db: MongoDB database holding checkpoints and failed rows
+        @param run_id: run the job belongs to, saved with its last run stats
+        """
+        self.source_model = source_model
+        self.target_model = target_model
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.progress_every = progress_every
+        self.progress = progress
+        self.run_id = run_id
+        self.schema_mapping = get_schema_mapping(target_model._meta.label)
+        self.state_collection = db[MIGRATION_STATE_COLLECTION] if db is not None else None
+        self.errors_collection = db[MIGRATION_ERRORS_COLLECTION] if db is not None else None
+        self.rows = 0
+        self.errors = []
+        self.saved_errors = 0
+        self.counted = 0
+        self.last_record_id = None
+        self.start = None
+        self.loader = None
+
+    @property
+    def job_id(self):
+        return f'{self.source_model._meta.label_lower}->{self.target_model._meta.label_lower}'
+
+    def get_checkpoint(self):
+        if self.state_collection is None:
+            return None
+        state = self.state_collection.find_one({'_id': self.job_id}) or {}
+        return state.get('last_record_id')
+
+    def save_checkpoint(self, status='running'):
+        """ Flushes pending rows before recording the last record id, so the
+            checkpoint never runs ahead of what is in the target.
+        """
+        self.loader.flush()
+        self.errors.extend(self.loader.errors)
+        self.loader.errors = []
+        increment_record_count(self.target_model, self.loader.created - self.counted)
+        self.counted = self.loader.created
+        if self.state_collection is None:
+            return
+
+        new_errors = self.errors[self.saved_errors:]
+        if new_errors:
+            self.errors_collection.insert_many([
+                {'job': self.job_id, 'record_id': record_id, 'error': error,
+                 'datetime_created': timezone.now()}
+                for record_id, error in new_errors])
+            self.saved_errors = len(self.errors)
+
+        stats = self.stats
+        last_run = {key: stats[key] for key in (
+            'rows', 'created', 'errors', 'seconds', 'rows_per_second')}
+        last_run['run_id'] = self.run_id
+        self.state_collection.update_one(
+            {'_id': self.job_id},
+            {'$set': {'last_record_id': self.last_record_id, 'status': status,
+                      'datetime_updated': timezone.now(),
+                      'last_run': last_run}},
+            upsert=True)
+
+    def clear_checkpoint(self):
+        if self.state_collection is not None:
+            self.state_collection.delete_one({'_id': self.job_id})
+
+    def iter_source_rows(self):
+        queryset = self.source_model.objects.values()
+        if self.last_record_id is not None:
+            queryset = queryset.filter(record_id__gt=self.last_record_id)
+        return queryset.order_by('record_id').iterator(chunk_size=self.chunk_size)
+
+    def migrate_row(self, row):
+        try:
+            values = self.schema_mapping.apply(row)
+        except (TypeError, ValueError, InvalidOperation) as e:
+            self.errors.append((row.get('record_id'), str(e)))
+            return
+        self.loader.add(values.pop('record_id', None), values)
+
+    @property
+    def stats(self):
+        seconds = time.perf_counter() - self.start if self.start else 0
+        return {'source': self.source_model._meta.label,
+                'target': self.target_model._meta.label,
+                'rows': self.rows,
+                'created': self.loader.created if self.loader else 0,
+                'errors': len(self.errors) + len(self.loader.errors if self.loader else []),
+                'last_record_id': self.last_record_id,
+                'seconds': round(seconds, 2),
+                'rows_per_second': round(self.rows / seconds, 1) if seconds else 0}
+
+    def report(self):
+        stats = self.stats
+        logger.debug(
+            f"{stats['source']} -> {stats['target']}: {stats['rows']} rows, "
+            f"{stats['created']} created, {stats['errors']} errors "
+            f"({stats['rows_per_second']} rows/s)")
+        if self.progress:
+            self.progress(stats)
+
+    def run(self):
+        self.start = time.perf_counter()
+        self.last_record_id = self.get_checkpoint()
+        self.loader = MigrationLoader(self.target_model, batch_size=self.batch_size)
+        for row in self.iter_source_rows():
+            self.migrate_row(row)
+            self.last_record_id = row.get('record_id')
+            self.rows += 1
+            if self.rows % self.progress_every == 0:
+                self.save_checkpoint()
+                self.report()
+        self.save_checkpoint(status='complete')
+        self.report()
+        return self.stats
@@ -40,6 +40,16 @@ class ExportFile(models.Model):
     download_complete = models.BooleanField(
         default=False,)
 
+    file_size = models.BigIntegerField(
+        verbose_name='File size (bytes)',
+        null=True,
+        blank=True)
+
+    uncompressed_size = models.BigIntegerField(
+        verbose_name='Uncompressed size (bytes)',
+        null=True,
+        blank=True)
+
     def save(self, *args, **kwargs):
         if self.datetime_started and self.datetime_completed:
             datetime_completed = self.datetime_completed.astimezone(tz)
@@ -62,14 +72,41 @@ class ExportFile(models.Model):
         _, extension = os.path.splitext(self.name)
         return extension
 
+    @property
+    def size(self):
+        """ File size stored when the export completed, exports made before
+            it was stored fall back to reading the file.
+        """
+        if self.file_size is not None:
+            return self.file_size
+        try:
+            return self.file.size if self.file else 0
+        except (OSError, ValueError):
+            return 0
+
+    @property
+    def is_compressed(self):
+        return self.name.endswith(('.gz', '.zst'))
+
     @property
     def sizify(self):
         """
             Simple kb/mb/gb size snippet for templates:
             {{ export.file.size|sizify }}
         """
+        return self.format_size(self.size)
+
+    @property
+    def uncompressed_sizify(self):
+        """ Size of a compressed export once decompressed, blank for
+            uncompressed exports.
+        """
+        if not self.is_compressed or self.uncompressed_size is None:
+            return ''
+        return self.format_size(self.uncompressed_size)
 
-        value = self.file.size if self.file else 0
+    @staticmethod
+    def format_size(value):
         if value < 512000:
             value = value / 1024.0
             ext = 'Kb'
@@ -83,6 +120,8 @@ class ExportFile(models.Model):
 
     @property
     def related_user(self):
+        if hasattr(self, '_related_user'):
+            return self._related_user
         user_model_cls = django_apps.get_model(settings.AUTH_USER_MODEL)
         if self.user_created:
             try:
@@ -93,6 +132,20 @@ class ExportFile(models.Model):
             else:
                 return user
 
+    @classmethod
+    def set_related_users(cls, export_files):
+        """ Resolves the users of many export files in one query, so listing
+            them does not look up each user separately.
+        """
+        user_model_cls = django_apps.get_model(settings.AUTH_USER_MODEL)
+        usernames = {export_file.user_created for export_file in export_files
+                     if export_file.user_created}
+        users = {user.username: user for user in user_model_cls.objects.filter(
+            username__in=usernames)} if usernames else {}
+        for export_file in export_files:
+            export_file._related_user = users.get(export_file.user_created)
+        return export_files
+
     @property
     def user_badge(self):
         user = self.related_user
@@ -0,0 +1,56 @@
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.utils import timezone
+
+RECORD_COUNT_KEY = 'tsepamo:record_count:{}'
+LAST_UPDATED_KEY = 'tsepamo:record_count_updated:{}'
+
+
+def refresh_record_count(model_cls):
+    """ Counts a model's records and caches the count with no expiry,
+        loaders keep it current and the reconcile task corrects any drift.
+        Recounting leaves the last updated time alone, nothing was written.
+    """
+    count = model_cls.objects.count()
+    cache.set(RECORD_COUNT_KEY.format(model_cls._meta.label_lower), count, timeout=None)
+    return count
+
+
+def get_record_count(model_cls):
+    count = cache.get(RECORD_COUNT_KEY.format(model_cls._meta.label_lower))
+    if count is None:
+        count = refresh_record_count(model_cls)
+    return count
+
+
+def get_record_stats(model_cls):
+    """ @return: {'count': records, 'last_updated': when records last changed}
+    """
+    count = get_record_count(model_cls)
+    return {'count': count,
+            'last_updated': cache.get(LAST_UPDATED_KEY.format(model_cls._meta.label_lower))}
+
+
+def increment_record_count(model_cls, created):
+    """ Adds newly created records to a cached count without counting the
+        collection, an uncached count is filled by a full count instead.
+    """
+    if not created:
+        return
+    label = model_cls._meta.label_lower
+    try:
+        cache.incr(RECORD_COUNT_KEY.format(label), created)
+    except ValueError:
+        refresh_record_count(model_cls)
+    cache.set(LAST_UPDATED_KEY.format(label), timezone.now(), timeout=None)
+
+
+def reconcile_record_counts(app_label='tsepamo'):
+    """ Recounts every record model of an app.
+        @return: {model label: count}
+    """
+    counts = {}
+    for model_cls in django_apps.get_app_config(app_label).get_models():
+        if any(field.name == 'record_id' for field in model_cls._meta.fields):
+            counts[model_cls._meta.label_lower] = refresh_record_count(model_cls)
+    return counts
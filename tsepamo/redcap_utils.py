@@ -0,0 +1,655 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import requests
+from collections import deque
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from django.utils import timezone
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from requests.adapters import HTTPAdapter, Retry
+from .file_store import ContentAddressedFileStore
+from .schema_mapping import get_redcap_schema_mapping
+
+logger = logging.getLogger('celery_progress')
+
+SYNC_STATE_COLLECTION = 'redcap_sync_state'
+TOKEN_LEASE_COLLECTION = 'redcap_token_leases'
+CONTENT_HASH_FIELD = '_content_hash'
+FILE_HASHES_FIELD = '_file_hashes'
+FILE_REFS_FIELD = '_file_refs'
+
+
+def record_hash(record):
+    """ Stable hash of a record's field values. Values are compared as
+        stripped strings and blank fields are left out, so formatting noise
+        and newly added empty fields do not count as a change.
+    """
+    values = {key: str(value).strip() for key, value in record.items()
+              if not key.startswith('_') and value is not None and str(value).strip()}
+    return hashlib.sha256(
+        json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class TokenBucket:
+    """ Token-bucket rate limiter shared by the threads of one client. The
+        refill rate is halved whenever REDCap throttles or fails a request
+        and creeps back up towards `max_rate` on each success.
+    """
+
+    def __init__(self, rate=5.0, capacity=5, min_rate=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+
+    def backoff(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class RedcapClient:
+    """ Minimal REDCap API client owning one pooled, keep-alive session.
+        Connection errors are retried by the session adapter, read timeouts
+        are raised to the caller so it can shrink its requests, throttling
+        (429) and server (5xx) responses are retried here so the rate
+        limiter can back off. Request latency and retry counts are kept
+        in `metrics`.
+    """
+
+    retry_status_codes = [429, 500, 502, 503, 504]
+
+    def __init__(self, api_url, token, rate=5.0, pool_size=10, max_retries=5,
+                 backoff_factor=2, timeout=300):
+        self.api_url = api_url
+        self.token = token
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(rate=rate)
+
+        retry_strategy = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=0,
+            backoff_factor=backoff_factor,
+            allowed_methods=['POST'])
+        adapter = HTTPAdapter(
+            max_retries=retry_strategy, pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.metrics_lock = threading.Lock()
+        self.metrics = {'requests': 0, 'retries': 0, 'failures': 0,
+                        'latency_total': 0.0, 'latency_max': 0.0, 'bytes_received': 0}
+
+    def post(self, payload):
+        payload = {'token': self.token, 'returnFormat': 'json', **payload}
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.api_url, data=payload, timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                self.record_request(time.perf_counter() - start, failed=True)
+                raise
+            self.record_request(
+                time.perf_counter() - start, bytes_received=len(response.content))
+
+            if response.status_code not in self.retry_status_codes:
+                self.rate_limiter.recover()
+                response.raise_for_status()
+                return response
+
+            self.rate_limiter.backoff()
+            if attempt == self.max_retries:
+                break
+            with self.metrics_lock:
+                self.metrics['retries'] += 1
+            retry_after = response.headers.get('Retry-After', '')
+            time.sleep(float(retry_after) if retry_after.isdigit()
+                       else self.backoff_factor * 2 ** attempt)
+
+        with self.metrics_lock:
+            self.metrics['failures'] += 1
+        response.raise_for_status()
+
+    def record_request(self, latency, failed=False, bytes_received=0):
+        with self.metrics_lock:
+            self.metrics['requests'] += 1
+            self.metrics['bytes_received'] += bytes_received
+            self.metrics['failures'] += int(failed)
+            self.metrics['latency_total'] += latency
+            self.metrics['latency_max'] = max(self.metrics['latency_max'], latency)
+
+    @property
+    def average_latency(self):
+        requests_count = self.metrics['requests']
+        return self.metrics['latency_total'] / requests_count if requests_count else 0
+
+    def export_metadata(self):
+        return self.post({'content': 'metadata', 'format': 'json'}).json()
+
+    def export_records(self, records=None, fields=None, forms=None, date_begin=None):
+        payload = {'content': 'record', 'format': 'json', 'type': 'flat'}
+        for key, values in (('records', records), ('fields', fields), ('forms', forms)):
+            for index, value in enumerate(values or []):
+                payload[f'{key}[{index}]'] = value
+        if date_begin:
+            payload['dateRangeBegin'] = date_begin.strftime('%Y-%m-%d %H:%M:%S')
+        return self.post(payload).json()
+
+    def export_file(self, record, field):
+        response = self.post({'content': 'file', 'action': 'export',
+                              'record': record, 'field': field})
+        return response.content, response.headers
+
+
+class AdaptiveChunkSize:
+    """ Sizes REDCap record export chunks from observed responses. The
+        size moves towards the number of records that would come back in
+        `target_seconds`, halves after a timeout and is capped so a single
+        response stays under `max_bytes`.
+    """
+
+    def __init__(self, initial=500, minimum=25, maximum=5000,
+                 target_seconds=30, max_bytes=50 * 1024 * 1024):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+
+    def observe(self, records_count, seconds, payload_bytes):
+        if not records_count or not seconds:
+            return self.size
+        by_time = records_count * self.target_seconds / seconds
+        by_bytes = records_count * self.max_bytes / payload_bytes if payload_bytes else by_time
+        # Grow at most twofold per chunk, shrink as far as needed
+        size = min(by_time, by_bytes, self.size * 2)
+        self.size = int(max(self.minimum, min(self.maximum, size)))
+        return self.size
+
+    def timed_out(self):
+        self.size = max(self.minimum, self.size // 2)
+        return self.size
+
+
+class TokenSemaphore:
+    """ Caps how many syncs use one REDCap token at a time, across every
+        Celery worker. Each slot is a lease document in MongoDB, a slot whose
+        lease has expired (e.g. its worker was killed) can be taken over.
+    """
+
+    def __init__(self, db, key, limit=2, lease_seconds=7200):
+        self.collection = db[TOKEN_LEASE_COLLECTION]
+        self.key = key
+        self.limit = limit
+        self.lease_seconds = lease_seconds
+        self.holder = None
+        self.slot_id = None
+
+    def acquire(self, holder):
+        """ Takes a free slot without blocking.
+            @return: True if a slot was taken
+        """
+        now = timezone.now()
+        for slot in range(self.limit):
+            slot_id = f'{self.key}:{slot}'
+            try:
+                result = self.collection.update_one(
+                    {'_id': slot_id,
+                     '$or': [{'holder': None}, {'expires': {'$lt': now}}]},
+                    {'$set': {'holder': holder,
+                              'expires': now + timedelta(seconds=self.lease_seconds)}},
+                    upsert=True)
+            except DuplicateKeyError:
+                continue
+            if result.matched_count or result.upserted_id:
+                self.holder = holder
+                self.slot_id = slot_id
+                return True
+        return False
+
+    def release(self):
+        if self.slot_id:
+            self.collection.update_one(
+                {'_id': self.slot_id, 'holder': self.holder},
+                {'$set': {'holder': None}})
+            self.slot_id = None
+
+
+class RedcapProjectSync:
+    """ Pulls records from a REDCap project into a MongoDB collection.
+        A full sync requests every record id and creates the records not yet
+        in the collection. An incremental sync only requests the records
+        created or edited since the last successful sync (REDCap's
+        `dateRangeBegin` filter) and upserts them. Either can be limited to
+        some instruments or fields, in which case every requested record is
+        upserted and the watermark is left for full-width syncs.
+
+        A shard syncs a given list of `record_ids` on behalf of an
+        orchestrating task, keeps its own checkpoint and leaves the project
+        watermark to the orchestrator.
+    """
+
+    max_chunk_retries = 3
+    chunk_retry_delay = 30
+
+    def __init__(self, project, db, project_name, collection_name,
+                 incremental=False, chunk_size=500, download_workers=8,
+                 target_chunk_seconds=30, forms=None, fields=None, record_ids=None,
+                 date_begin=None, shard=None):
+        self.project = project
+        self.project_name = project_name
+        self.collection_name = collection_name
+        self.db = db
+        self.collection = db[collection_name]
+        self.state_collection = db[SYNC_STATE_COLLECTION]
+        self.incremental = incremental
+        self.chunk_sizer = AdaptiveChunkSize(
+            initial=chunk_size, target_seconds=target_chunk_seconds)
+        self.download_workers = download_workers
+        self.forms = forms or []
+        self.fields = fields or []
+        self.record_ids = record_ids
+        self.date_begin = date_begin
+        self.shard = shard
+        self.chunk_stats = []
+        self.unchanged_count = 0
+        self._file_store = None
+        self.schema_mapping = get_redcap_schema_mapping()
+        self.retry_queue = deque()
+        self.failed_record_ids = []
+
+    @property
+    def state_filter(self):
+        return {'project_name': self.project_name,
+                'collection_name': self.collection_name,
+                'shard': self.shard}
+
+    def get_last_sync(self):
+        state = self.state_collection.find_one(self.state_filter)
+        return state.get('last_sync') if state else None
+
+    def set_last_sync(self, last_sync):
+        self.state_collection.update_one(
+            self.state_filter, {'$set': {'last_sync': last_sync}}, upsert=True)
+
+    @property
+    def scope(self):
+        """ Identifies what a sync pulls, so only a checkpoint left by the
+            same kind of sync is resumed.
+        """
+        if not self.is_subset:
+            return 'all'
+        return ','.join(sorted(self.forms) + sorted(self.fields))
+
+    def get_checkpoint(self):
+        state = self.state_collection.find_one(self.state_filter) or {}
+        checkpoint = state.get('checkpoint')
+        if checkpoint and checkpoint.get('scope') == self.scope:
+            return checkpoint
+        return None
+
+    def save_checkpoint(self, **values):
+        values = {f'checkpoint.{key}': value for key, value in values.items()}
+        self.state_collection.update_one(
+            self.state_filter, {'$set': values}, upsert=True)
+
+    def clear_checkpoint(self):
+        self.state_collection.update_one(
+            self.state_filter,
+            {'$unset': {'checkpoint': ''},
+             '$set': {'failed_record_ids': self.failed_record_ids}})
+
+    def resume_record_ids(self, record_ids, checkpoint):
+        """ Orders the run's record ids, the previous sync's failed ids first,
+            and finds where an interrupted run stopped. Chunks that failed
+            before the interruption are queued for retry, so the offset
+            into the ordered ids stays valid across resumes.
+            @return: (ordered record ids, offset of the first id to sync)
+        """
+        retry_ids = checkpoint.get('retry_record_ids', [])
+        retry_set = set(retry_ids)
+        record_ids = retry_ids + [record_id for record_id in record_ids
+                                  if record_id not in retry_set]
+        offset = min(checkpoint.get('offset', 0), len(record_ids))
+        last_record_id = checkpoint.get('last_record_id')
+        if (offset and record_ids[offset - 1] != last_record_id
+                and last_record_id in record_ids):
+            # The project's ids changed since the checkpoint, resume after
+            # the last synced record instead.
+            offset = record_ids.index(last_record_id) + 1
+
+        failed_ids = checkpoint.get('failed_record_ids', [])
+        if failed_ids:
+            self.retry_queue.append((failed_ids, 0))
+        return record_ids, offset
+
+    def update_field_variables(self, records):
+        return self.schema_mapping.apply_many(records)
+
+    def get_metadata(self):
+        return self.project.export_metadata()
+
+    def get_record_ids(self, date_begin=None):
+        """ Returns the project record ids, only the id strings are kept
+            from the REDCap response.
+        """
+        records = self.project.export_records(
+            fields=['record_id'], date_begin=date_begin)
+        return [record.get('record_id') for record in records]
+
+    def iter_chunks(self, record_ids):
+        """ Yields chunks of record ids, sized by the adaptive chunk size at
+            the time each chunk is requested.
+        """
+        start = 0
+        while start < len(record_ids):
+            size = self.chunk_sizer.size
+            yield record_ids[start:start + size]
+            start += size
+
+    def filter_new_record_ids(self, record_ids):
+        """ Returns the record ids of a chunk not yet stored, looked up with a
+            single indexed `$in` query rather than against every stored id.
+        """
+        stored = self.collection.find(
+            {'record_id': {'$in': record_ids}}, {'_id': 0, 'record_id': 1})
+        stored_ids = {record['record_id'] for record in stored}
+        return [record_id for record_id in record_ids
+                if record_id not in stored_ids]
+
+    @property
+    def is_subset(self):
+        return bool(self.forms or self.fields)
+
+    @property
+    def export_fields(self):
+        """ Fields requested from REDCap, the record id is always included
+            so a subset of fields can be matched to its record.
+        """
+        if not self.is_subset:
+            return None
+        return ['record_id', *[field for field in self.fields if field != 'record_id']]
+
+    def get_file_fields(self, metadata):
+        return [field['field_name'] for field in metadata
+                if field['field_type'] == 'file' and (
+                    not self.is_subset or field['field_name'] in self.fields or
+                    field.get('form_name') in self.forms)]
+
+    def get_project_records(self, record_ids):
+        return self.project.export_records(
+            records=record_ids, fields=self.export_fields, forms=self.forms or None)
+
+    def download_file(self, record_id, field_name):
+        try:
+            content, _ = self.project.export_file(record_id, field_name)
+            return content
+        except requests.exceptions.RequestException as e:
+            logger.error(f'Failed downloading {field_name} for {record_id}: {e}')
+            return None
+
+    @property
+    def file_store(self):
+        if self._file_store is None:
+            self._file_store = ContentAddressedFileStore(self.db)
+        return self._file_store
+
+    def store_file(self, record_id, field_name, file_store=None):
+        """ Downloads a file field into the content addressed file store.
+            @return: (file path, content hash), or None when the download failed
+        """
+        file_content = self.download_file(record_id, field_name)
+        if file_content is None:
+            return None
+        return (file_store or self.file_store).put(file_content, record_id, field_name)
+
+    def download_files(self, records, file_fields, stored=None):
+        """ Downloads the file fields of a chunk on a bounded thread pool
+            and points each record's file field at its stored path. A file
+            whose REDCap reference matches the stored one keeps its stored
+            blob without a download. A record with a failed download loses
+            its content hash, so the next sync does not skip it.
+            @param stored: {record_id: stored document}, from get_stored_hashes
+        """
+        stored = stored or {}
+        downloads = []
+        for record in records:
+            stored_record = stored.get(record['record_id'], {})
+            for field in file_fields:
+                if not record.get(field):
+                    continue
+                if (stored_record.get(field)
+                        and stored_record.get(FILE_REFS_FIELD, {}).get(field) == record[field]):
+                    record[field] = stored_record[field]
+                    continue
+                downloads.append((record, field))
+        if not downloads:
+            return
+
+        file_store = self.file_store
+        with ThreadPoolExecutor(max_workers=self.download_workers) as executor:
+            stored_files = executor.map(
+                lambda download: self.store_file(
+                    download[0]['record_id'], download[1], file_store), downloads)
+            for (record, field), stored_file in zip(downloads, stored_files):
+                if stored_file is None:
+                    if CONTENT_HASH_FIELD in record:
+                        record[CONTENT_HASH_FIELD] = None
+                    continue
+                record[f'{FILE_REFS_FIELD}.{field}'] = record[field]
+                record[field], record[f'{FILE_HASHES_FIELD}.{field}'] = stored_file
+
+    def get_stored_hashes(self, record_ids, file_fields=()):
+        """ @return: {record_id: stored content hash, file fields and their
+                REDCap references}
+        """
+        projection = {'record_id': 1, CONTENT_HASH_FIELD: 1, FILE_REFS_FIELD: 1}
+        projection.update((field, 1) for field in file_fields)
+        documents = self.collection.find({'record_id': {'$in': record_ids}}, projection)
+        return {document['record_id']: document for document in documents}
+
+    def update_or_create_model(self, records, file_fields):
+        """ Upserts a chunk of records with one unordered `bulk_write`.
+            Records whose content hash matches the stored one are skipped,
+            along with their file downloads. Subset pulls only carry some
+            fields, so they are always written and leave the hash alone.
+            @return: bulk write result, or None when nothing was written
+        """
+        records = self.update_field_variables(records)
+
+        stored = {}
+        if records and (file_fields or not self.is_subset):
+            stored = self.get_stored_hashes(
+                [record['record_id'] for record in records], file_fields)
+        if not self.is_subset and records:
+            for record in records:
+                record[CONTENT_HASH_FIELD] = record_hash(record)
+            changed = [record for record in records
+                       if stored.get(record['record_id'], {}).get(CONTENT_HASH_FIELD)
+                       != record[CONTENT_HASH_FIELD]]
+            self.unchanged_count += len(records) - len(changed)
+            records = changed
+
+        self.download_files(records, file_fields, stored)
+
+        operations = [
+            UpdateOne({'record_id': record['record_id']},  # Search for a record with this ID
+                      {'$set': record},  # Update the record with new data
+                      upsert=True)  # Create the record if it doesn't exist
+            for record in records]
+
+        if not operations:
+            return None
+        return self.collection.bulk_write(operations, ordered=False)
+
+    def sync_chunk(self, record_ids, file_fields, attempt=0):
+        """ Pulls and stores one chunk of records, queueing the chunk for a
+            later retry when the request fails rather than dropping it.
+        """
+        chunk_size = self.chunk_sizer.size
+        start = time.perf_counter()
+        bytes_received = self.project.metrics['bytes_received']
+        try:
+            chunk_data = self.get_project_records(record_ids)
+        except requests.exceptions.RequestException as e:
+            if isinstance(e, requests.exceptions.Timeout):
+                self.chunk_sizer.timed_out()
+            logger.error(
+                f'{self.project_name}: chunk of {len(record_ids)} records failed: {e}')
+            self.chunk_stats.append(
+                {'records': len(record_ids), 'chunk_size': chunk_size,
+                 'seconds': round(time.perf_counter() - start, 2), 'error': str(e)})
+            self.retry_queue.append((record_ids, attempt + 1))
+            return None
+
+        fetch_seconds = time.perf_counter() - start
+        payload_bytes = self.project.metrics['bytes_received'] - bytes_received
+        self.chunk_sizer.observe(len(record_ids), fetch_seconds, payload_bytes)
+
+        unchanged_count = self.unchanged_count
+        result = self.update_or_create_model(chunk_data, file_fields)
+        return self.record_chunk_stats(
+            chunk_data, result, time.perf_counter() - start,
+            chunk_size=chunk_size, fetch_seconds=fetch_seconds,
+            payload_bytes=payload_bytes, unchanged=self.unchanged_count - unchanged_count)
+
+    def retry_failed_chunks(self, file_fields):
+        while self.retry_queue:
+            record_ids, attempt = self.retry_queue.popleft()
+            if attempt > self.max_chunk_retries:
+                self.failed_record_ids.extend(record_ids)
+                continue
+            time.sleep(self.chunk_retry_delay * attempt)
+            # Re-split with the current size, which shrinks after timeouts
+            for chunk_ids in self.iter_chunks(record_ids):
+                self.sync_chunk(chunk_ids, file_fields, attempt)
+
+        if self.failed_record_ids:
+            logger.error(f'{self.project_name}: {len(self.failed_record_ids)} '
+                         'records could not be pulled after retries')
+
+    def record_chunk_stats(self, records, result, seconds, chunk_size=None,
+                           fetch_seconds=None, payload_bytes=None, unchanged=0):
+        stats = {'records': len(records),
+                 'chunk_size': chunk_size,
+                 'inserted': result.upserted_count if result else 0,
+                 'modified': result.modified_count if result else 0,
+                 'unchanged': unchanged,
+                 'fetch_seconds': round(fetch_seconds or 0, 2),
+                 'payload_bytes': payload_bytes,
+                 'seconds': round(seconds, 2),
+                 'records_per_second': round(len(records) / seconds, 1) if seconds else 0}
+        self.chunk_stats.append(stats)
+        logger.debug(
+            f"{self.project_name}: {stats['records']} records, {stats['inserted']} inserted, "
+            f"{stats['modified']} modified, {stats['unchanged']} unchanged in {stats['seconds']}s "
+            f"({stats['records_per_second']} records/s, fetch {stats['fetch_seconds']}s, "
+            f"{payload_bytes} bytes), next chunk size {self.chunk_sizer.size}")
+        return stats
+
+    def save_run_stats(self, sync_started):
+        """ Keeps the chunk stats of the latest run on the sync state, so
+            operators can see why a sync was slow.
+        """
+        self.state_collection.update_one(
+            self.state_filter,
+            {'$set': {'last_run': {'started': sync_started,
+                                   'chunk_stats': self.chunk_stats}}},
+            upsert=True)
+
+    def sync(self):
+        """ Runs the sync and records its start time as the watermark for
+            the next incremental sync, so edits made while it runs are
+            picked up next time. Progress is checkpointed after every chunk,
+            a sync interrupted part way resumes from its last completed
+            chunk with the same start time and date range.
+        """
+        checkpoint = self.get_checkpoint()
+        if checkpoint:
+            sync_started = checkpoint['sync_started']
+            last_sync = checkpoint.get('date_begin')
+        else:
+            sync_started = timezone.localtime().replace(tzinfo=None)
+            if self.record_ids is not None:
+                last_sync = self.date_begin
+            else:
+                last_sync = self.get_last_sync() if self.incremental else None
+            self.save_checkpoint(scope=self.scope, sync_started=sync_started,
+                                 date_begin=last_sync, offset=0, last_record_id=None,
+                                 retry_record_ids=self.get_failed_record_ids(),
+                                 failed_record_ids=[])
+
+        # Get metadata and determine file fields
+        metadata = self.get_metadata()
+        file_fields = self.get_file_fields(metadata)
+
+        self.collection.create_index('record_id')
+        if self.record_ids is not None:
+            record_ids = list(self.record_ids)
+        else:
+            record_ids = self.get_record_ids(date_begin=last_sync)
+        record_ids, offset = self.resume_record_ids(
+            record_ids, checkpoint or self.get_checkpoint())
+
+        # Export data in chunks
+        for chunk_ids in self.iter_chunks(record_ids[offset:]):
+            # Records already stored are skipped on a full sync, changed
+            # records are always rewritten on an incremental or subset one.
+            new_ids = chunk_ids
+            if not last_sync and not self.is_subset:
+                new_ids = self.filter_new_record_ids(chunk_ids)
+
+            if new_ids:
+                self.sync_chunk(new_ids, file_fields)
+
+            offset += len(chunk_ids)
+            self.save_checkpoint(
+                offset=offset, last_record_id=chunk_ids[-1],
+                failed_record_ids=self.get_outstanding_record_ids())
+
+        self.retry_failed_chunks(file_fields)
+        self.save_run_stats(sync_started)
+        self.clear_checkpoint()
+
+        # Leave the watermark in place while chunks are outstanding, so the
+        # next incremental sync requests those records again.
+        if not self.failed_record_ids and not self.is_subset and self.shard is None:
+            self.set_last_sync(sync_started)
+
+    def get_failed_record_ids(self):
+        """ Record ids left failed by the previous sync, retried first.
+        """
+        state = self.state_collection.find_one(self.state_filter) or {}
+        return state.get('failed_record_ids', [])
+
+    def get_outstanding_record_ids(self):
+        return self.failed_record_ids + [
+            record_id for record_ids, _ in self.retry_queue for record_id in record_ids]
@@ -0,0 +1,115 @@
+from functools import lru_cache
+from django.apps import apps as django_apps
+from .field_converters import get_model_converters
+
+# Source field names renamed to the target model's field, per target model.
+FIELD_RENAMES = {
+    'tsepamo.tsepamo': {
+        'placental_organism': 'placenta_organism',
+        'placental_pcdecid': 'placenta_pcdecid',
+        'placental_avascvilli': 'placenta_avascvilli',
+        'placental_distalvh': 'placenta_distalvh',
+        'placental_fetalmalp': 'placenta_fetalmalp',
+        'was_this_woman_on_aspirin': 'was_this_woman_aspirin',
+    },
+    'tsepamo.outcomes': {
+        'surgery_describe': 'surgery_details',
+        'ipms_followup': 'imps_followup',
+    },
+}
+
+# REDCap projects export every instrument in one record.
+REDCAP_FIELD_RENAMES = {source: target for renames in FIELD_RENAMES.values()
+                        for source, target in renames.items()}
+
+CHECKED_VALUES = frozenset(['1', 1, 'Checked'])
+
+
+class SchemaMapping:
+    """ Maps source records onto a target schema: renames fields, collapses
+        REDCap checkbox expansions (`field___code`) into their field, coerces
+        values to the target model's field types and drops keys the target
+        does not have. The plan for a set of record keys is compiled once and
+        reused, since every record of a batch carries the same keys.
+    """
+
+    def __init__(self, renames=None, model_cls=None, collapse_checkboxes=True,
+                 exclude_fields=('id',)):
+        """
+        @param renames: {source field: target field}
+        @param model_cls: target model, when set values are coerced to its
+            field types and keys it does not have are dropped
+        @param collapse_checkboxes: join checked `field___code` codes with ', '
+        @param exclude_fields: target fields never carried over
+        """
+        self.renames = dict(renames or {})
+        self.collapse_checkboxes = collapse_checkboxes
+        self.exclude_fields = frozenset(exclude_fields)
+        self.field_names = None
+        self.converters = {}
+        if model_cls is not None:
+            self.field_names = frozenset(
+                field.name for field in model_cls._meta.fields) - self.exclude_fields
+            self.converters = get_model_converters(model_cls)
+        self._plans = {}
+
+    def compile(self, keys):
+        """ Builds the plan for records with these keys.
+            @return: (plain columns, checkbox groups), plain columns are
+                (source key, target key, converter) and checkbox groups are
+                {target key: ([(source key, code)], converter)}
+        """
+        plain_columns = []
+        checkbox_groups = {}
+        for key in keys:
+            base, _, code = key.partition('___') if self.collapse_checkboxes else (key, '', '')
+            target = self.renames.get(base, base)
+            if target in self.exclude_fields or (
+                    self.field_names is not None and target not in self.field_names):
+                continue
+            converter = self.converters.get(target)
+            if code:
+                checkbox_groups.setdefault(target, ([], converter))[0].append((key, code))
+            else:
+                plain_columns.append((key, target, converter))
+        return plain_columns, checkbox_groups
+
+    def get_plan(self, keys):
+        keys = tuple(keys)
+        plan = self._plans.get(keys)
+        if plan is None:
+            plan = self._plans[keys] = self.compile(keys)
+        return plan
+
+    def apply(self, record):
+        plain_columns, checkbox_groups = self.get_plan(record)
+        mapped = {}
+        for key, target, converter in plain_columns:
+            value = record[key]
+            mapped[target] = converter(value) if converter else value
+        for target, (options, converter) in checkbox_groups.items():
+            codes = [code for key, code in options if record[key] in CHECKED_VALUES]
+            value = ', '.join(codes) if codes else None
+            mapped[target] = converter(value) if converter else value
+        return mapped
+
+    def apply_many(self, records):
+        return [self.apply(record) for record in records]
+
+
+@lru_cache(maxsize=None)
+def get_schema_mapping(model_label):
+    """ Mapping onto a consolidated model, e.g. `tsepamo.tsepamo`, shared by
+        the REDCap sync and the data migration.
+    """
+    model_cls = django_apps.get_model(model_label)
+    return SchemaMapping(renames=FIELD_RENAMES.get(model_label.lower()),
+                         model_cls=model_cls)
+
+
+def get_redcap_schema_mapping():
+    """ Mapping for whole REDCap project records stored in MongoDB, which
+        hold every instrument so keys are renamed and collapsed but not
+        checked against one model.
+    """
+    return SchemaMapping(renames=REDCAP_FIELD_RENAMES)
@@ -1,17 +1,21 @@
 import ast
+import hashlib
 import logging
-import requests
 import time
+import uuid
 from datetime import datetime
 from django.conf import settings
 from django.core.mail import EmailMessage
-from celery import shared_task
-from redcap import Project
-from requests.adapters import HTTPAdapter, Retry
+from django.utils import timezone
+from celery import chain, chord, group, shared_task
+from django.apps import apps as django_apps
 from tsepamo.utils import LoadCSVData
+from .redcap_utils import (RedcapClient, RedcapProjectSync, SYNC_STATE_COLLECTION,
+                           TokenSemaphore)
 from .export_utils import GenerateDataExports
+from .record_stats import reconcile_record_counts
+from .migration_utils import MIGRATION_JOBS, MIGRATION_STATE_COLLECTION, ModelMigration
 from pymongo import MongoClient
-import os
 from celery.exceptions import SoftTimeLimitExceeded
 
 logger = logging.getLogger('celery_progress')
@@ -28,29 +32,66 @@ def get_mongo_client():
     return _client
 
 
+TSEPAMO_CSV_FILES = [('/home/datacore/source/datacore/Tsepamo_1.csv',
+                      ['tsepamo.tsepamoone', 'tsepamo.outcomesone']),
+                     ('/home/datacore/source/datacore/Tsepamo_2.csv',
+                      ['tsepamo.tsepamotwo', 'tsepamo.outcomestwo', 'tsepamo.switcheripmstwo',
+                       'tsepamo.personalidentifierstwo', 'tsepamo.ipmstwo']),
+                     ('/home/datacore/source/datacore/Tsepamo_3.csv',
+                      ['tsepamo.tsepamothree', 'tsepamo.outcomesthree', 'tsepamo.switcheripmsthree',
+                       'tsepamo.personalidentifiersthree']),
+                     ('/home/datacore/source/datacore/Tsepamo_4.csv',
+                      ['tsepamo.tsepamofour', 'tsepamo.outcomesfour', 'tsepamo.switcheripmsfour',
+                       'tsepamo.personalidentifiersfour'])]
+
+
 @shared_task()
-def run_load_model_data_task():
+def run_load_model_data_task(batch_size=1000, update_existing=False):
+    """ Fans the CSV load out as one subtask per (file, model) pair, so the
+        instrument models load concurrently across workers, and summarises
+        the results once every subtask has finished.
+    """
     logger.debug("The data files")
 
-    csv_files = [('/home/datacore/source/datacore/Tsepamo_1.csv',
-                  ['tsepamo.tsepamoone', 'tsepamo.outcomesone']),
-                 ('/home/datacore/source/datacore/Tsepamo_2.csv',
-                  ['tsepamo.tsepamotwo', 'tsepamo.outcomestwo', 'tsepamo.switcheripmstwo',
-                   'tsepamo.personalidentifierstwo', 'tsepamo.ipmstwo']),
-                 ('/home/datacore/source/datacore/Tsepamo_3.csv',
-                  ['tsepamo.tsepamothree', 'tsepamo.outcomesthree', 'tsepamo.switcheripmsthree',
-                   'tsepamo.personalidentifiersthree']),
-                 ('/home/datacore/source/datacore/Tsepamo_4.csv',
-                  ['tsepamo.tsepamofour', 'tsepamo.outcomesfour', 'tsepamo.switcheripmsfour',
-                   'tsepamo.personalidentifiersfour'])]
+    load_jobs = [load_csv_model_data_task.s(csv_file, model_name, batch_size, update_existing)
+                 for csv_file, model_names in TSEPAMO_CSV_FILES
+                 for model_name in model_names]
+    return chord(load_jobs)(summarise_load_model_data_task.s())
+
 
+@shared_task()
+def load_csv_model_data_task(csv_file, model_name, batch_size=1000, update_existing=False):
+    start = time.perf_counter()
     try:
-        tsepamo_data = LoadCSVData()
-        logger.debug("Now loading data")
-        tsepamo_data.load_model_data_all(csv_files)
+        tsepamo_data = LoadCSVData(
+            batch_size=batch_size, update_existing=update_existing)
+        logger.debug(f"Now loading {model_name} from {csv_file}")
+        loaders = tsepamo_data.load_model_data_all([(csv_file, [model_name])])
     except Exception as exc:
+        logger.error(f"Failed loading {model_name} from {csv_file}: {exc}")
         raise exc
 
+    return {'csv_file': csv_file,
+            'model_name': model_name,
+            'created': sum(loader.created for loader in loaders),
+            'updated': sum(loader.updated for loader in loaders),
+            'seconds': round(time.perf_counter() - start, 2)}
+
+
+@shared_task()
+def summarise_load_model_data_task(results):
+    for result in results:
+        logger.debug(
+            f"{result['model_name']} ({result['csv_file']}): created {result['created']}, "
+            f"updated {result['updated']} in {result['seconds']}s")
+
+    summary = {'models': len(results),
+               'created': sum(result['created'] for result in results),
+               'updated': sum(result['updated'] for result in results),
+               'seconds': max([result['seconds'] for result in results], default=0)}
+    logger.debug(f"Load model data complete: {summary}")
+    return summary
+
 
 @shared_task
 def generate_exports(export_name, user_created, user_emails=[], app_label='', export_type='csv',
@@ -74,120 +115,32 @@ def generate_exports(export_name, user_created, user_emails=[], app_label='', ex
 
 
 @shared_task(bind=True, soft_time_limit=7000, time_limit=7200)
-def export_project_data_and_send_email(self, project_name, emails=[], collection_name=None):
-
-    def update_field_variables(record):
-        field_mapping = {
-            'placental_organism': 'placenta_organism',
-            'placental_pcdecid': 'placenta_pcdecid',
-            'placental_avascvilli': 'placenta_avascvilli',
-            'placental_distalvh': 'placenta_distalvh',
-            'placental_fetalmalp': 'placenta_fetalmalp',
-            'was_this_woman_on_aspirin': 'was_this_woman_aspirin',
-            'surgery_describe': 'surgery_details',
-            'ipms_followup': 'imps_followup'
-        }
-
-        mapped_record = {field_mapping.get(k, k): v for k, v in record.items()}
-        return mapped_record
-
-    def get_metadata(project):
-        try:
-            return project.export_metadata()
-        except requests.exceptions.RequestException as e:
-            print(f'Request error: {e}')
-            time.sleep(5)  # Sleep for a bit before retrying
-            return []
-
-    def get_project_records(project, record_ids):
-        try:
-            return project.export_records(records=record_ids)
-        except requests.exceptions.RequestException as e:
-            print(f'Request error: {e}')
-            time.sleep(5)  # Sleep for a bit before retrying
-            return []
-
-    def download_file(project, record_id, field_name):
-        try:
-            content, _ = project.export_file(record_id, field_name)
-            return content
-        except requests.exceptions.RequestException as e:
-            print(f'Request error: {e}')
-            time.sleep(5)  # Sleep for a bit before retrying
-            return None
-
-    def update_or_create_model(project, collection, record, file_fields):
-        record = update_field_variables(record)
-        record_id = record['record_id']
-
-        for field in file_fields:
-            if field in record and record[field]:
-                file_content = download_file(project, record_id, field)
-                file_name = f"{record_id}_{field}.jpg"
-                file_path = os.path.join(settings.MEDIA_ROOT, file_name)
-                if file_content is not None:
-                    with open(file_path, 'wb') as f:
-                        f.write(file_content)
-                    record[field] = file_path
-
-        print(f'Create/update record {record_id}')
-
-        collection.update_one(
-            {'record_id': record_id},  # Search for a record with this ID
-            {'$set': record},  # Update the record with new data
-            upsert=True  # Create the record if it doesn't exist
-            )
+def export_project_data_and_send_email(self, project_name, emails=[], collection_name=None,
+                                       incremental=False, download_workers=8, forms=None,
+                                       fields=None):
     try:
         # Connect to REDCap
-        project = Project(
-            settings.REDCAP_API_URL, REDCAP_API_KEYS.get(project_name))
-
-        # Export total records to get count
-        total_records = project.export_records(fields=['record_id'])
-        total_count = len(total_records)
-        chunk_size = 500
-
-        # Get metadata and determine file fields
-        metadata = get_metadata(project)
-        file_fields = [field['field_name']
-                       for field in metadata if field['field_type'] == 'file']
-
-        # Setup retry strategy
-        retry_strategy = Retry(
-            total=20,  # Number of retries
-            backoff_factor=10,  # Wait between retries
-            # Retry on these status codes
-            status_forcelist=[429, 500, 502, 503, 504],
-            # Allow retry on these methods
-            method_whitelist=["HEAD", "GET", "OPTIONS", "POST"]
-        )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http = requests.Session()
-        http.mount("https://", adapter)
-        http.mount("http://", adapter)
+        project = RedcapClient(
+            settings.REDCAP_API_URL, REDCAP_API_KEYS.get(project_name),
+            pool_size=download_workers)
 
         print('Creating database connection...')
         client = get_mongo_client()
         db = client[settings.MONGO_DB_NAME]
-        collection = db[collection_name]
-
-        # retrieve mongodb records
-        all_records = collection.find({}, {'_id': 0, 'record_id': 1})
-        record_id_list = [record['record_id'] for record in all_records]
 
-        # Export data in chunks
-        for start in range(0, total_count, chunk_size):
-            end = start + chunk_size
-            record_ids = [record.get('record_id') for record in total_records[start:end]
-                          if record.get('record_id') not in record_id_list]
+        project_sync = RedcapProjectSync(
+            project, db, project_name, collection_name,
+            incremental=incremental, download_workers=download_workers,
+            forms=forms, fields=fields)
+        project_sync.sync()
+        logger.debug(
+            f'{project_name}: {project.metrics["requests"]} REDCap requests, '
+            f'{project.metrics["retries"]} retries, {project.metrics["failures"]} failures, '
+            f'average latency {project.average_latency:.2f}s')
 
-            if not record_ids:
-                continue
-
-            chunk_data = get_project_records(project, record_ids)
-            for record in chunk_data:
-                print(f"Record id {record.get('record_id')}")
-                update_or_create_model(project, collection, record, file_fields)
+        if project_sync.failed_record_ids:
+            raise Exception(
+                f'{len(project_sync.failed_record_ids)} records could not be pulled')
 
         # Send success email notification
         success_email = EmailMessage(
@@ -199,14 +152,10 @@ def export_project_data_and_send_email(self, project_name, emails=[], collection
         success_email.send()
 
     except SoftTimeLimitExceeded:
+        # The sync checkpoints every chunk, so the retry resumes where this
+        # slice stopped rather than needing a longer time limit.
         self.update_state(state='FAILURE')
-        new_soft_time_limit = self.soft_time_limit + 3600
-        new_time_limit = self.time_limit + 3600
-        self.retry(
-            countdown=10,
-            max_retries=5,
-            soft_time_limit=new_soft_time_limit,
-            time_limit=new_time_limit)
+        self.retry(countdown=10, max_retries=50)
 
     except Exception as e:
         # Log the error and send a failure notification email
@@ -219,3 +168,226 @@ def export_project_data_and_send_email(self, project_name, emails=[], collection
         )
         failure_email.send()
         raise e
+
+
+def split_record_ids(record_ids, shards):
+    """ Splits record ids into contiguous record ranges, one per shard.
+    """
+    record_ids = sorted(set(record_ids), key=lambda record_id: (len(record_id), record_id))
+    size = -(-len(record_ids) // max(shards, 1))
+    return [record_ids[start:start + size] for start in range(0, len(record_ids), size or 1)]
+
+
+@shared_task()
+def sync_redcap_projects_task(project_names, emails=[], collection_name=None, incremental=False,
+                              shards=4, max_concurrency=2, download_workers=8):
+    """ Fans each project's records out over record range shards synced by
+        separate workers, at most `max_concurrency` shards use a REDCap
+        token at once. One summary email is sent when every shard is done.
+    """
+    client = get_mongo_client()
+    db = client[settings.MONGO_DB_NAME]
+    run_id = uuid.uuid4().hex[:8]
+
+    header = []
+    sync_started = {}
+    for project_name in project_names:
+        project = RedcapClient(settings.REDCAP_API_URL, REDCAP_API_KEYS.get(project_name))
+        project_sync = RedcapProjectSync(project, db, project_name, collection_name)
+        date_begin = project_sync.get_last_sync() if incremental else None
+        # Taken before listing ids, records edited while the run is queued
+        # are picked up by the next incremental sync.
+        sync_started[project_name] = timezone.localtime().replace(tzinfo=None).isoformat()
+        record_ids = (project_sync.get_failed_record_ids()
+                      + project_sync.get_record_ids(date_begin=date_begin))
+        shard_ranges = split_record_ids(record_ids, shards)
+        logger.debug(f'{project_name}: {len(record_ids)} records over {len(shard_ranges)} shards')
+
+        for shard, shard_ids in enumerate(shard_ranges):
+            header.append(sync_redcap_shard_task.s(
+                project_name, f'{run_id}:{shard}', shard_ids, collection_name,
+                date_begin.isoformat() if date_begin else None, max_concurrency,
+                download_workers))
+
+    return chord(header)(summarise_redcap_sync_task.s(
+        project_names, emails, collection_name, run_id, sync_started, time.time()))
+
+
+@shared_task(bind=True, soft_time_limit=7000, time_limit=7200)
+def sync_redcap_shard_task(self, project_name, shard, record_ids, collection_name=None,
+                           date_begin=None, max_concurrency=2, download_workers=8):
+    token = REDCAP_API_KEYS.get(project_name)
+    client = get_mongo_client()
+    db = client[settings.MONGO_DB_NAME]
+
+    semaphore = TokenSemaphore(
+        db, hashlib.sha256(token.encode()).hexdigest()[:16], limit=max_concurrency)
+    if not semaphore.acquire(self.request.id):
+        # Every slot for this token is busy, wait for a running shard.
+        raise self.retry(countdown=30, max_retries=None)
+
+    start = time.perf_counter()
+    project = project_sync = error = None
+    try:
+        project = RedcapClient(settings.REDCAP_API_URL, token, pool_size=download_workers)
+        project_sync = RedcapProjectSync(
+            project, db, project_name, collection_name, download_workers=download_workers,
+            record_ids=record_ids, shard=shard,
+            date_begin=datetime.fromisoformat(date_begin) if date_begin else None)
+        project_sync.sync()
+    except SoftTimeLimitExceeded:
+        # The shard checkpoints every chunk, the retry resumes from there.
+        raise self.retry(countdown=10, max_retries=50)
+    except Exception as e:
+        # Reported by the summary rather than failing the chord, the shard's
+        # records are kept as failed so the next run retries them.
+        logger.exception(f'{project_name} shard {shard} failed')
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        semaphore.release()
+
+    chunk_stats = project_sync.chunk_stats if project_sync else []
+    metrics = project.metrics if project else {}
+    return {'project_name': project_name,
+            'shard': shard,
+            'records': sum(stats['records'] for stats in chunk_stats),
+            'inserted': sum(stats['inserted'] for stats in chunk_stats),
+            'modified': sum(stats['modified'] for stats in chunk_stats),
+            'unchanged': project_sync.unchanged_count if project_sync else 0,
+            'requests': metrics.get('requests', 0),
+            'retries': metrics.get('retries', 0),
+            'failed_record_ids': list(record_ids) if error else project_sync.failed_record_ids,
+            'error': error,
+            'seconds': round(time.perf_counter() - start, 2)}
+
+
+@shared_task()
+def summarise_redcap_sync_task(results, project_names, emails=[], collection_name=None,
+                               run_id=None, sync_started=None, started_at=None):
+    """ Merges shard results per project, moves each project's watermark
+        when none of its records failed and emails one summary.
+        @param sync_started: {project name: isoformat time its ids were listed}
+    """
+    client = get_mongo_client()
+    state_collection = client[settings.MONGO_DB_NAME][SYNC_STATE_COLLECTION]
+    elapsed = time.time() - started_at if started_at else 0
+
+    summary = {}
+    for project_name in project_names:
+        shard_results = [result for result in results
+                         if result['project_name'] == project_name]
+        failed_ids = [record_id for result in shard_results
+                      for record_id in result['failed_record_ids']]
+        errors = [f"shard {result['shard']}: {result['error']}"
+                  for result in shard_results if result.get('error')]
+        records = sum(result['records'] for result in shard_results)
+        summary[project_name] = {
+            'shards': len(shard_results),
+            'records': records,
+            'inserted': sum(result['inserted'] for result in shard_results),
+            'modified': sum(result['modified'] for result in shard_results),
+            'unchanged': sum(result['unchanged'] for result in shard_results),
+            'requests': sum(result['requests'] for result in shard_results),
+            'retries': sum(result['retries'] for result in shard_results),
+            'failed': len(failed_ids),
+            'errors': errors,
+            'records_per_second': round(records / elapsed, 1) if elapsed else 0}
+
+        state_filter = {'project_name': project_name,
+                        'collection_name': collection_name,
+                        'shard': None}
+        values = {'failed_record_ids': failed_ids}
+        if not failed_ids:
+            values['last_sync'] = datetime.fromisoformat(sync_started[project_name])
+        state_collection.update_one(state_filter, {'$set': values}, upsert=True)
+        state_collection.delete_many({'project_name': project_name,
+                                      'collection_name': collection_name,
+                                      'shard': {'$regex': f'^{run_id}:'}})
+
+    lines = [f"{project_name}: {stats['records']} records over {stats['shards']} shards, "
+             f"{stats['inserted']} inserted, {stats['modified']} modified, "
+             f"{stats['unchanged']} unchanged, "
+             f"{stats['failed']} failed, {stats['requests']} requests "
+             f"({stats['retries']} retries), {stats['records_per_second']} records/s"
+             for project_name, stats in summary.items()]
+    lines.extend(f'{project_name} {error}' for project_name, stats in summary.items()
+                 for error in stats['errors'])
+    logger.debug('\n'.join(lines))
+
+    failed = any(stats['failed'] or stats['errors'] for stats in summary.values())
+    EmailMessage(
+        'Project Data Export Incomplete' if failed else 'Project Data Export Complete',
+        f'REDCap sync finished in {elapsed:.0f}s.\n\n' + '\n'.join(lines),
+        settings.DEFAULT_FROM_EMAIL,
+        emails,
+    ).send()
+    return summary
+
+
+@shared_task()
+def run_data_migration_task(batch_size=1000, chunk_size=2000, target_models=None):
+    """ Runs the legacy model migrations, one chain per target model in
+        parallel. Sources feeding the same target run one after another so
+        they never race on a record id.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    jobs = {target_model: source_models for target_model, source_models in MIGRATION_JOBS.items()
+            if not target_models or target_model in target_models}
+    chains = [chain(*[migrate_model_task.si(source_model, target_model, batch_size, chunk_size,
+                                            run_id)
+                      for source_model in source_models])
+              for target_model, source_models in jobs.items()]
+    job_ids = [f'{source_model}->{target_model}'
+               for target_model, source_models in jobs.items()
+               for source_model in source_models]
+    return chord(group(chains))(summarise_data_migration_task.s(job_ids, run_id))
+
+
+@shared_task(bind=True, soft_time_limit=7000, time_limit=7200)
+def migrate_model_task(self, source_model, target_model, batch_size=1000, chunk_size=2000,
+                       run_id=None):
+    db = get_mongo_client()[settings.MONGO_DB_NAME]
+    try:
+        return ModelMigration(
+            django_apps.get_model(source_model), django_apps.get_model(target_model),
+            batch_size=batch_size, chunk_size=chunk_size, db=db, run_id=run_id).run()
+    except SoftTimeLimitExceeded:
+        # The migration checkpoints as it goes, the retry resumes from there.
+        raise self.retry(countdown=10, max_retries=50)
+
+
+@shared_task()
+def summarise_data_migration_task(results, job_ids=(), run_id=None):
+    """ Reports the run's jobs from their saved state, since a chain hands on
+        only its last job's result. A job with no stats saved by this run,
+        e.g. after an earlier job of its chain failed, is reported not run.
+        @param job_ids: `source->target` ids of the jobs the run scheduled
+    """
+    db = get_mongo_client()[settings.MONGO_DB_NAME]
+    states = {state['_id']: state for state in db[MIGRATION_STATE_COLLECTION].find(
+        {'_id': {'$in': list(job_ids)}})}
+    summary = {}
+    for job_id in job_ids:
+        state = states.get(job_id, {})
+        last_run = state.get('last_run', {})
+        if last_run.get('run_id') != run_id:
+            summary[job_id] = 'not run'
+            logger.debug(f'{job_id}: not run')
+            continue
+        summary[job_id] = state.get('status')
+        logger.debug(
+            f"{job_id} ({state.get('status')}): {last_run.get('created')} created "
+            f"from {last_run.get('rows')} rows, {last_run.get('errors')} errors "
+            f"({last_run.get('rows_per_second')} rows/s)")
+    return summary
+
+
+@shared_task()
+def reconcile_record_counts_task():
+    """ Recounts every record model, correcting cached counts that drifted
+        from writes made outside the loaders.
+    """
+    counts = reconcile_record_counts()
+    logger.debug(f'Reconciled record counts for {len(counts)} models')
+    return counts
+
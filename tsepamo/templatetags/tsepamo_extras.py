@@ -8,7 +8,11 @@ register = template.Library()
 def render_datatable(data_url, columns, table_id='default', url_kwargs={},
                      show_checkbox=True, allow_select_all=True,
                      include_seach_panes=True, download_action=False,
-                     date_sort=False):
+                     date_sort=False, server_side=False):
+    """ Renders a DataTable loading rows from `data_url`. With `server_side`
+        set, DataTables requests one page at a time and search, ordering and
+        search pane counts are computed by the view.
+    """
 
     data_url = reverse(data_url, kwargs=url_kwargs) if data_url else ""
     return {
@@ -19,6 +23,7 @@ def render_datatable(data_url, columns, table_id='default', url_kwargs={},
         'show_checkbox': show_checkbox,
         'allow_select_all': allow_select_all,
         'download_action': download_action,
+        'server_side': server_side,
         'include_seach_panes': include_seach_panes}
 
 
@@ -1,9 +1,68 @@
-from django.test import TestCase
-from tsepamo.models import TsepamoOne,OutcomesOne
-from tsepamo.utils import LoadCSVData
+import csv
+import datetime
+import gzip
+import json
+import os
+import tempfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
+import requests
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from celery.exceptions import SoftTimeLimitExceeded
+from django.test import RequestFactory, TestCase, override_settings
+from tsepamo.models import Tsepamo, TsepamoOne, OutcomesOne
+from tsepamo.models import (ExportFile, InstrumentsMeta, PersonalIdentifiersTwo, Projects,
+                            SwitcherIpms, SwitcherIpmsTwo)
+from tsepamo.export_utils import iter_merged_records, iter_model_data, stream_to_csv
+from tsepamo.field_converters import convert_date, format_record, get_model_converters
+from tsepamo import file_store
+from tsepamo.file_store import ContentAddressedFileStore, sniff_file_type
+from tsepamo import record_stats
+from tsepamo.migration_utils import MigrationLoader, ModelMigration
+from tsepamo.redcap_utils import (AdaptiveChunkSize, RedcapClient, RedcapProjectSync,
+                                   TokenSemaphore)
+from tsepamo.schema_mapping import get_redcap_schema_mapping, get_schema_mapping
+from tsepamo.tasks import (get_mongo_client, load_csv_model_data_task,
+                           run_load_model_data_task, split_record_ids,
+                           summarise_data_migration_task, summarise_load_model_data_task,
+                           summarise_redcap_sync_task, sync_redcap_shard_task)
+from tsepamo.utils import CSVColumnPlan, LoadCSVData
+from tsepamo.views.data_exports import (
+    fetch_fields_view, form_data_view, get_repository_details, project_data_view,
+    repository_datatable_response)
+from tsepamo.views.datatables import datatable_response
+from tsepamo.views.file_downloads import file_download_response
 from django.test import tag
+
+
+class MongoTestMixin:
+    """ Points MONGO_DB_NAME at a throwaway database dropped after each
+        test, so tests never write to the configured database.
+    """
+
+    def setUp(self):
+        super().setUp()
+        db_name = f'test_datacore_{uuid.uuid4().hex[:12]}'
+        mongo_settings = override_settings(MONGO_DB_NAME=db_name)
+        mongo_settings.enable()
+        self.addCleanup(mongo_settings.disable)
+        self.addCleanup(get_mongo_client().drop_database, db_name)
+        self.db = get_mongo_client()[db_name]
+
+
+# Record counts are cached, keep them out of the configured Redis cache.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
 # Create your tests here.
 tag('load')
+@override_settings(CACHES=LOCMEM_CACHES)
 class TestLoadData(TestCase):
 
 
@@ -15,3 +74,770 @@ class TestLoadData(TestCase):
         self.loading.load_model_data_all(self.csv_files_models)
         self.assertEqual(TsepamoOne.objects.count(),10)
         
+
+
+class TestStreamingExport(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+        for record_id in [3, 1, 2]:
+            PersonalIdentifiersTwo.objects.create(record_id=record_id, omang=100 + record_id)
+        for record_id in [2, 5]:
+            SwitcherIpmsTwo.objects.create(record_id=record_id)
+
+    def test_merged_records_ordered_by_record_id(self):
+        records = list(iter_merged_records(
+            'tsepamo', ['personalidentifierstwo', 'switcheripmstwo'], []))
+        self.assertEqual([record['record_id'] for record in records], [1, 2, 3, 5])
+        self.assertEqual(records[1]['omang'], 102)
+
+    def test_stream_to_csv_writes_export_file(self):
+        export_file = ExportFile.objects.create(
+            name='streamed.csv', file='documents/streamed.csv')
+        file_path = stream_to_csv(
+            'tsepamo', ['personalidentifierstwo', 'switcheripmstwo'], [], export_file.id)
+        self.assertTrue(file_path.startswith(settings.MEDIA_ROOT))
+        with open(file_path) as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]['record_id'], '1')
+
+    def test_stream_to_compressed_csv(self):
+        export_file = ExportFile.objects.create(
+            name='streamed.csv.gz', file='documents/streamed.csv.gz')
+        file_path = stream_to_csv(
+            'tsepamo', ['personalidentifierstwo', 'switcheripmstwo'], [], export_file.id,
+            compression='gz', compression_level=1)
+        with gzip.open(file_path, 'rt', newline='') as f:
+            content = f.read()
+        self.assertEqual(len(list(csv.DictReader(content.splitlines()))), 4)
+
+        export_file.refresh_from_db()
+        self.assertEqual(export_file.uncompressed_size, len(content.encode()))
+        self.assertTrue(export_file.uncompressed_sizify)
+
+
+class TestKeysetFetch(TestCase):
+
+    def setUp(self):
+        for record_id in range(1, 8):
+            SwitcherIpmsTwo.objects.create(record_id=record_id)
+
+    def test_iter_model_data_pages_all_records(self):
+        records = list(iter_model_data(SwitcherIpmsTwo, [], chunk_size=3))
+        self.assertEqual([record['record_id'] for record in records], list(range(1, 8)))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestBulkModelLoader(TestCase):
+
+    def setUp(self):
+        SwitcherIpmsTwo.objects.create(record_id=1, cd4any='0')
+        self.data = [{'record_id': '1', 'cd4any': '1', 'recentcd4': '350'},
+                     {'record_id': '2', 'cd4any': '1', 'recentcd4': ''},
+                     {'record_id': '3', 'cd4any': '0', 'recentcd4': '120'}]
+
+    def test_load_creates_only_new_records(self):
+        LoadCSVData(batch_size=1).load_model_data(self.data, ['tsepamo.switcheripmstwo'])
+        self.assertEqual(SwitcherIpmsTwo.objects.count(), 3)
+        self.assertEqual(SwitcherIpmsTwo.objects.get(record_id=1).cd4any, '0')
+        self.assertEqual(SwitcherIpmsTwo.objects.get(record_id=3).recentcd4, 120)
+
+    def test_load_updates_existing_records(self):
+        LoadCSVData(update_existing=True).load_model_data(
+            self.data, ['tsepamo.switcheripmstwo'])
+        self.assertEqual(SwitcherIpmsTwo.objects.get(record_id=1).cd4any, '1')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestLoadCSVTasks(TestCase):
+
+    def setUp(self):
+        self.csv_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with self.csv_file as f:
+            csv.writer(f).writerows([['record_id', 'cd4any'], ['1', '0'], ['2', '1']])
+        self.model_names = ['tsepamo.switcheripmstwo', 'tsepamo.personalidentifierstwo']
+
+    def tearDown(self):
+        os.remove(self.csv_file.name)
+
+    def test_load_fans_out_per_file_and_model(self):
+        with mock.patch('tsepamo.tasks.TSEPAMO_CSV_FILES',
+                        [(self.csv_file.name, self.model_names)]), \
+                mock.patch('tsepamo.tasks.chord') as chord:
+            run_load_model_data_task(batch_size=10)
+
+        header = chord.call_args.args[0]
+        self.assertEqual([job.args for job in header],
+                         [(self.csv_file.name, model_name, 10, False)
+                          for model_name in self.model_names])
+
+    def test_each_subtask_loads_only_its_model(self):
+        results = [load_csv_model_data_task(self.csv_file.name, 'tsepamo.switcheripmstwo')]
+        self.assertEqual(SwitcherIpmsTwo.objects.count(), 2)
+        self.assertEqual(PersonalIdentifiersTwo.objects.count(), 0)
+
+        results.append(load_csv_model_data_task(self.csv_file.name,
+                                                'tsepamo.personalidentifierstwo'))
+        summary = summarise_load_model_data_task(results)
+        self.assertEqual((summary['models'], summary['created'], summary['updated']), (2, 4, 0))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestModelMigration(MongoTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        for record_id, cd4any in [(1, '0'), (2, '1'), (3, '1')]:
+            SwitcherIpmsTwo.objects.create(record_id=record_id, cd4any=cd4any)
+        SwitcherIpms.objects.create(id=uuid.uuid4(), record_id=1, cd4any='9')
+
+    def test_migration_inserts_missing_records(self):
+        progress = []
+        stats = ModelMigration(SwitcherIpmsTwo, SwitcherIpms, batch_size=1,
+                               progress_every=2, progress=progress.append).run()
+
+        self.assertEqual((stats['rows'], stats['created'], stats['errors']), (3, 2, 0))
+        self.assertEqual(len(progress), 2)
+        self.assertEqual(SwitcherIpms.objects.get(record_id=1).cd4any, '9')
+        self.assertEqual(SwitcherIpms.objects.get(record_id=3).cd4any, '1')
+
+    def test_unconvertible_row_is_kept_as_error(self):
+        migration = ModelMigration(TsepamoOne, Tsepamo)
+        migration.loader = MigrationLoader(Tsepamo)
+        migration.migrate_row({'record_id': 4, 'placenta_nga': 'n/a'})
+
+        self.assertEqual(migration.errors[0][0], 4)
+        self.assertEqual(migration.loader.pending, [])
+
+    def test_migration_resumes_after_checkpoint(self):
+        migration = ModelMigration(SwitcherIpmsTwo, SwitcherIpms, db=self.db)
+        self.db['data_migration_state'].update_one(
+            {'_id': migration.job_id}, {'$set': {'last_record_id': 2}}, upsert=True)
+        stats = migration.run()
+        state = self.db['data_migration_state'].find_one({'_id': migration.job_id})
+
+        self.assertEqual((stats['rows'], stats['created']), (1, 1))
+        self.assertFalse(SwitcherIpms.objects.filter(record_id=2).exists())
+        self.assertEqual((state['status'], state['last_record_id']), ('complete', 3))
+
+
+    def test_summary_reports_only_this_runs_jobs(self):
+        ModelMigration(SwitcherIpmsTwo, SwitcherIpms, db=self.db, run_id='old').run()
+        ModelMigration(SwitcherIpmsTwo, SwitcherIpms, db=self.db, run_id='new').run()
+        self.db['data_migration_state'].insert_one(
+            {'_id': 'tsepamo.outcomesone->tsepamo.outcomes', 'status': 'complete',
+             'last_run': {'run_id': 'old'}})
+
+        summary = summarise_data_migration_task(
+            None, ['tsepamo.switcheripmstwo->tsepamo.switcheripms',
+                   'tsepamo.switcheripmsthree->tsepamo.switcheripms'], 'new')
+        self.assertEqual(summary, {'tsepamo.switcheripmstwo->tsepamo.switcheripms': 'complete',
+                                   'tsepamo.switcheripmsthree->tsepamo.switcheripms': 'not run'})
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestRecordStats(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        SwitcherIpmsTwo.objects.create(record_id=1, cd4any='0')
+
+    def test_count_is_cached_and_incremented(self):
+        self.assertEqual(record_stats.get_record_count(SwitcherIpmsTwo), 1)
+        LoadCSVData().load_model_data([{'record_id': '2', 'cd4any': '1'}],
+                                      ['tsepamo.switcheripmstwo'])
+        with self.assertNumQueries(0):
+            stats = record_stats.get_record_stats(SwitcherIpmsTwo)
+        self.assertEqual(stats['count'], 2)
+        self.assertIsNotNone(stats['last_updated'])
+
+    def test_reconcile_corrects_drift(self):
+        record_stats.get_record_count(SwitcherIpmsTwo)
+        SwitcherIpmsTwo.objects.create(record_id=2, cd4any='1')
+        self.assertEqual(record_stats.reconcile_record_counts()['tsepamo.switcheripmstwo'], 2)
+        self.assertEqual(record_stats.get_record_stats(SwitcherIpmsTwo),
+                         {'count': 2, 'last_updated': None})
+
+
+class TestCSVColumnPlan(TestCase):
+
+    def test_checkbox_columns_are_collapsed(self):
+        plan = CSVColumnPlan(['record_id', 'site', 'meds___1', 'meds___2', 'meds___3', 'other'],
+                             field_names={'record_id', 'site', 'meds'})
+        self.assertEqual(plan.map_row(['7', '2', '0', '1', '1', 'x']),
+                         {'record_id': '7', 'site': '2', 'meds': '2, 3'})
+        self.assertEqual(plan.map_row(['8', '1', '0', '0', '0', 'x']),
+                         {'record_id': '8', 'site': '1', 'meds': None})
+
+    def test_short_rows_leave_missing_columns_empty(self):
+        plan = CSVColumnPlan(['record_id', 'site', 'meds___1', 'meds___2'],
+                             field_names={'record_id', 'site', 'meds'})
+        self.assertEqual(plan.map_row(['9', '3', '1']),
+                         {'record_id': '9', 'site': '3', 'meds': '1'})
+        self.assertEqual(plan.map_row(['10']),
+                         {'record_id': '10', 'site': None, 'meds': None})
+
+
+class TestFieldConverters(TestCase):
+
+    def test_model_converters_format_record(self):
+        converters = get_model_converters(SwitcherIpmsTwo)
+        self.assertNotIn('record_id', converters)
+        record = format_record(converters, {'recentcd4': '350', 'recentcd4date': '2021-03-04',
+                                            'cd4any': ''})
+        self.assertEqual(record['recentcd4'], 350)
+        self.assertEqual(record['recentcd4date'], datetime.date(2021, 3, 4))
+        self.assertIsNone(record['cd4any'])
+        self.assertIsNone(record['cd4nadir'])
+
+    def test_day_month_date_fallback(self):
+        self.assertEqual(convert_date('2021-25-03'), datetime.date(2021, 3, 25))
+        with self.assertRaises(ValueError):
+            convert_date('not a date')
+
+
+class RedcapStandInHandler(BaseHTTPRequestHandler):
+    """ Answers the subset of the REDCap API used by the sync from the
+        in-memory project held on the server.
+    """
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        payload = {key: values[0] for key, values in parse_qs(
+            self.rfile.read(length).decode()).items()}
+        self.server.requests.append(payload)
+
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_response(self.server.failure_status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content_type = 'application/json'
+        if payload['content'] == 'metadata':
+            content = json.dumps(self.server.metadata).encode()
+        elif payload['content'] == 'file':
+            content = self.server.files[(payload['record'], payload['field'])]
+            content_type = f'image/jpeg; name="{payload["field"]}.jpg"'
+        else:
+            content = json.dumps(self.export_records(payload)).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def export_records(self, payload):
+        record_ids = [value for key, value in payload.items() if key.startswith('records[')]
+        fields = [value for key, value in payload.items() if key.startswith('fields[')]
+        forms = [value for key, value in payload.items() if key.startswith('forms[')]
+        fields.extend(field['field_name'] for field in self.server.metadata
+                      if field['form_name'] in forms)
+        date_begin = payload.get('dateRangeBegin')
+        if date_begin:
+            date_begin = datetime.datetime.strptime(date_begin, '%Y-%m-%d %H:%M:%S')
+
+        records = []
+        for record_id, (modified, record) in self.server.records.items():
+            if record_ids and record_id not in record_ids:
+                continue
+            if date_begin and modified < date_begin:
+                continue
+            records.append({k: v for k, v in record.items() if not fields or k in fields})
+        return records
+
+    def log_message(self, *args):
+        pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestRedcapProjectSync(MongoTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RedcapStandInHandler)
+        self.server.requests = []
+        self.server.metadata = [
+            {'field_name': 'record_id', 'form_name': 'tsepamo', 'field_type': 'text'},
+            {'field_name': 'site', 'form_name': 'tsepamo', 'field_type': 'dropdown'},
+            {'field_name': 'placenta_photo', 'form_name': 'tsepamo', 'field_type': 'file'},
+            {'field_name': 'infant_status', 'form_name': 'outcomes', 'field_type': 'radio'}]
+        self.server.files = {}
+        self.server.failures = 0
+        self.server.failure_status = 503
+        earlier = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.server.records = {'1': (earlier, {'record_id': '1', 'site': '1'}),
+                               '2': (earlier, {'record_id': '2', 'site': '2'})}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.project = RedcapClient(
+            f'http://127.0.0.1:{self.server.server_port}/api/', 'A' * 32, backoff_factor=0)
+        self.collection_name = 'test_redcap_sync'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sync(self, incremental):
+        self.server.requests = []
+        RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                          incremental=incremental).sync()
+        return [value for payload in self.server.requests
+                for key, value in payload.items() if key.startswith('records[')]
+
+    def test_incremental_sync_pulls_edited_records(self):
+        self.assertEqual(self.sync(incremental=True), ['1', '2'])
+
+        later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        self.server.records['1'] = (later, {'record_id': '1', 'site': '5'})
+
+        self.assertEqual(self.sync(incremental=True), ['1'])
+        collection = self.db[self.collection_name]
+        self.assertEqual(collection.find_one({'record_id': '1'})['site'], '5')
+        self.assertEqual(collection.count_documents({}), 2)
+
+    def test_full_sync_skips_stored_records(self):
+        self.sync(incremental=False)
+        later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        self.server.records['3'] = (later, {'record_id': '3', 'site': '3'})
+
+        self.assertEqual(self.sync(incremental=False), ['3'])
+
+    def test_only_missing_ids_are_requested(self):
+        self.db[self.collection_name].insert_many([{'record_id': '2'}, {'record_id': '7'}])
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name)
+        self.assertEqual(sync.filter_new_record_ids(['3', '2', '1']), ['3', '1'])
+
+        self.assertEqual(self.sync(incremental=False), ['1'])
+
+    def test_chunk_stats_count_inserted_and_modified(self):
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name)
+        sync.sync()
+        self.assertEqual(sync.chunk_stats[0]['inserted'], 2)
+
+        later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+        self.server.records['2'] = (later, {'record_id': '2', 'site': '9'})
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                                 incremental=True)
+        sync.sync()
+        self.assertEqual(sync.chunk_stats[0]['modified'], 1)
+
+    def test_file_fields_are_downloaded(self):
+        self.server.records['1'][1]['placenta_photo'] = 'photo.jpg'
+        self.server.files[('1', 'placenta_photo')] = b'\xff\xd8\xffjpeg-bytes'
+
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.sync(incremental=False)
+            record = self.db[self.collection_name].find_one({'record_id': '1'})
+            with open(record['placenta_photo'], 'rb') as f:
+                self.assertEqual(f.read(), b'\xff\xd8\xffjpeg-bytes')
+            content_hash = record['_file_hashes']['placenta_photo']
+            self.assertEqual(
+                os.path.relpath(record['placenta_photo'], media_root),
+                os.path.join('redcap_files', content_hash[:2], content_hash[2:4],
+                             f'{content_hash}.jpg'))
+
+    def test_unchanged_files_of_changed_records_are_not_downloaded(self):
+        self.server.records['1'][1]['placenta_photo'] = 'photo.jpg'
+        self.server.files[('1', 'placenta_photo')] = b'\xff\xd8\xffjpeg-bytes'
+
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.sync(incremental=True)
+                path = self.db[self.collection_name].find_one({'record_id': '1'})['placenta_photo']
+
+                later = datetime.datetime.now() + datetime.timedelta(minutes=1)
+                self.server.records['1'] = (
+                    later, dict(self.server.records['1'][1], site='9'))
+                sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1',
+                                         self.collection_name, incremental=True)
+                with mock.patch.object(sync, 'download_file') as download_file:
+                    sync.sync()
+                download_file.assert_not_called()
+
+                self.server.records['1'] = (
+                    later, dict(self.server.records['1'][1], placenta_photo='photo_2.jpg'))
+                sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1',
+                                         self.collection_name, incremental=True)
+                with mock.patch.object(sync, 'download_file',
+                                       return_value=b'%PDF-1.4') as download_file:
+                    sync.sync()
+                download_file.assert_called_once_with('1', 'placenta_photo')
+
+        record = self.db[self.collection_name].find_one({'record_id': '1'})
+        self.assertNotEqual(record['placenta_photo'], path)
+        self.assertEqual(record['_file_refs'], {'placenta_photo': 'photo_2.jpg'})
+
+    def test_unchanged_records_are_skipped(self):
+        self.server.records['1'][1]['placenta_photo'] = 'photo.jpg'
+        self.server.files[('1', 'placenta_photo')] = b'jpeg-bytes'
+
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root):
+                self.sync(incremental=True)
+                self.server.records['2'] = (
+                    datetime.datetime.now(), {'record_id': '2', 'site': '2 '})
+                sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1',
+                                         self.collection_name, record_ids=['1', '2'],
+                                         date_begin=datetime.datetime.now())
+                with mock.patch.object(sync, 'download_file') as download_file:
+                    sync.sync()
+                download_file.assert_not_called()
+        self.assertEqual(sync.unchanged_count, 2)
+        self.assertEqual(sync.chunk_stats[0]['modified'], 0)
+
+    def test_form_subset_pull(self):
+        self.sync(incremental=False)
+        self.server.records['1'][1]['infant_status'] = '1'
+        self.server.records['1'][1]['site'] = '7'
+
+        RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                          forms=['outcomes']).sync()
+        self.assertIn('forms[0]', self.server.requests[-1])
+        record = self.db[self.collection_name].find_one({'record_id': '1'})
+        self.assertEqual(record['infant_status'], '1')
+        self.assertEqual(record['site'], '1')
+
+    def test_throttled_requests_are_retried(self):
+        self.server.failure_status = 429
+        self.server.failures = 2
+        self.sync(incremental=False)
+        self.assertEqual(self.db[self.collection_name].count_documents({}), 2)
+        self.assertEqual(self.project.metrics['retries'], 2)
+
+    def test_failed_chunks_are_retried(self):
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name)
+        sync.chunk_retry_delay = 0
+        records = self.project.export_records(records=['1', '2'])
+        with mock.patch.object(sync, 'get_project_records', side_effect=[
+                requests.exceptions.ConnectionError('REDCap unavailable'), records]):
+            sync.sync()
+        self.assertEqual(sync.failed_record_ids, [])
+        self.assertEqual(self.db[self.collection_name].count_documents({}), 2)
+
+    def test_interrupted_sync_resumes_from_checkpoint(self):
+        for record_id in ['3', '4']:
+            self.server.records[record_id] = (
+                datetime.datetime.now(), {'record_id': record_id, 'site': '1'})
+
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                                 chunk_size=2)
+        with mock.patch.object(sync, 'update_or_create_model', side_effect=[
+                None, SoftTimeLimitExceeded()]):
+            with self.assertRaises(SoftTimeLimitExceeded):
+                sync.sync()
+
+        checkpoint = sync.get_checkpoint()
+        self.assertEqual(checkpoint['last_record_id'], '2')
+
+        self.assertEqual(self.sync(incremental=False), ['3', '4'])
+        self.assertIsNone(sync.get_checkpoint())
+
+    def test_resume_after_chunk_of_previously_failed_ids(self):
+        for record_id in ['3', '4']:
+            self.server.records[record_id] = (
+                datetime.datetime.now(), {'record_id': record_id, 'site': '1'})
+        self.db['redcap_sync_state'].update_one(
+            {'project_name': 'tsepamo_1', 'collection_name': self.collection_name,
+             'shard': None},
+            {'$set': {'failed_record_ids': ['3', '4']}}, upsert=True)
+
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                                 chunk_size=2)
+        with mock.patch.object(sync, 'update_or_create_model', side_effect=[
+                None, SoftTimeLimitExceeded()]):
+            with self.assertRaises(SoftTimeLimitExceeded):
+                sync.sync()
+        self.assertEqual(sync.get_checkpoint()['offset'], 2)
+
+        self.assertEqual(self.sync(incremental=False), ['1', '2'])
+
+    def test_shard_syncs_its_range_and_leaves_watermark(self):
+        self.server.records['3'] = (
+            datetime.datetime.now(), {'record_id': '3', 'site': '1'})
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name,
+                                 record_ids=['2', '3'], shard='run:0')
+        sync.sync()
+
+        self.assertEqual(
+            sorted(self.db[self.collection_name].distinct('record_id')), ['2', '3'])
+        self.assertIsNone(
+            RedcapProjectSync(self.project, self.db, 'tsepamo_1',
+                              self.collection_name).get_last_sync())
+
+    def test_failed_shard_is_reported_in_summary(self):
+        sync_started = {'tsepamo_1': datetime.datetime.now().isoformat()}
+        url = f'http://127.0.0.1:{self.server.server_port}/api/'
+        with override_settings(REDCAP_API_URL=url), \
+                mock.patch('tsepamo.tasks.REDCAP_API_KEYS', {'tsepamo_1': 'A' * 32}):
+            results = [sync_redcap_shard_task(
+                'tsepamo_1', 'run:0', ['1'], self.collection_name)]
+            with mock.patch.object(RedcapProjectSync, 'sync', side_effect=RuntimeError('down')):
+                results.append(sync_redcap_shard_task(
+                    'tsepamo_1', 'run:1', ['2'], self.collection_name))
+
+        summary = summarise_redcap_sync_task(
+            results, ['tsepamo_1'], ['team@example.com'], self.collection_name, 'run',
+            sync_started)
+
+        self.assertEqual(summary['tsepamo_1']['errors'], ['shard run:1: RuntimeError: down'])
+        self.assertEqual(mail.outbox[0].subject, 'Project Data Export Incomplete')
+        self.assertIn('RuntimeError: down', mail.outbox[0].body)
+        sync = RedcapProjectSync(self.project, self.db, 'tsepamo_1', self.collection_name)
+        self.assertIsNone(sync.get_last_sync())
+        self.assertEqual(sync.get_failed_record_ids(), ['2'])
+        self.assertEqual(self.db['redcap_sync_state'].count_documents(
+            {'shard': {'$regex': '^run:'}}), 0)
+
+    def test_token_semaphore_caps_holders(self):
+        first = TokenSemaphore(self.db, 'test-token', limit=1)
+        second = TokenSemaphore(self.db, 'test-token', limit=1)
+        self.assertTrue(first.acquire('task-1'))
+        self.assertFalse(second.acquire('task-2'))
+        first.release()
+        self.assertTrue(second.acquire('task-2'))
+
+    def test_split_record_ids_into_ranges(self):
+        self.assertEqual(split_record_ids(['10', '2', '1', '3', '2'], 2),
+                         [['1', '2'], ['3', '10']])
+
+
+class TestContentAddressedFileStore(MongoTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.store = ContentAddressedFileStore(self.db, root=self.media_root.name)
+
+    def tearDown(self):
+        self.media_root.cleanup()
+
+    def test_identical_blobs_are_stored_once(self):
+        png = b'\x89PNG\r\n\x1a\nimage'
+        first_path, content_hash = self.store.put(png, '1', 'placenta_photo')
+        second_path, _ = self.store.put(png, '2', 'placenta_photo')
+
+        self.assertEqual(first_path, second_path)
+        self.assertTrue(first_path.endswith(f'{content_hash}.png'))
+        self.assertEqual(
+            len(self.db['redcap_files'].find_one({'_id': content_hash})['references']), 2)
+
+    def test_blobs_are_readable_and_failed_writes_cleaned_up(self):
+        path, _ = self.store.put(b'%PDF-1.4 consent', '1', 'consent_form')
+        self.assertEqual(os.stat(path).st_mode & 0o777, file_store.FILE_MODE)
+
+        with mock.patch('tsepamo.file_store.os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.store.put(b'%PDF-1.4 other', '2', 'consent_form')
+        self.assertEqual([name for _, _, names in os.walk(self.media_root.name)
+                          for name in names], [os.path.basename(path)])
+
+    def test_lookup_follows_changed_file(self):
+        self.store.put(b'%PDF-1.4 first', '1', 'consent_form')
+        path, content_hash = self.store.put(b'%PDF-1.4 second', '1', 'consent_form')
+
+        self.assertEqual(self.store.lookup('1', 'consent_form')['_id'], content_hash)
+        self.assertEqual(self.db['redcap_files'].count_documents(
+            {'references.record_id': '1'}), 1)
+
+    def test_sniff_file_type(self):
+        self.assertEqual(sniff_file_type(b'\xff\xd8\xff\xe0'), ('jpg', 'image/jpeg'))
+        self.assertEqual(sniff_file_type(b'plain text'), ('bin', 'application/octet-stream'))
+
+
+class TestSchemaMapping(TestCase):
+
+    def test_model_mapping(self):
+        mapping = get_schema_mapping('tsepamo.outcomes')
+        record = mapping.apply({'id': 5, 'record_id': '7', 'ipms_followup': 'yes',
+                                'date_of_delivery': '2020-01-31', 'not_a_field': 'x'})
+        self.assertEqual(record, {'record_id': '7', 'imps_followup': 'yes',
+                                  'date_of_delivery': datetime.date(2020, 1, 31)})
+
+    def test_redcap_mapping_collapses_checkboxes(self):
+        mapping = get_redcap_schema_mapping()
+        records = mapping.apply_many([
+            {'record_id': '1', 'placental_organism': '2', 'race___1': '1', 'race___2': '1'},
+            {'record_id': '2', 'placental_organism': '', 'race___1': '0', 'race___2': '0'}])
+        self.assertEqual(records, [
+            {'record_id': '1', 'placenta_organism': '2', 'race': '1, 2'},
+            {'record_id': '2', 'placenta_organism': '', 'race': None}])
+        self.assertEqual(len(mapping._plans), 1)
+
+
+class TestDataTablesServerSide(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.params = {'draw': '3', 'start': '0', 'length': '2',
+                       'columns[0][data]': '', 'columns[1][data]': 'name',
+                       'columns[2][data]': 'field_type',
+                       'order[0][column]': '1', 'order[0][dir]': 'desc'}
+
+    def test_rows_are_searched_ordered_and_paged(self):
+        rows = [{'name': name, 'field_type': field_type} for name, field_type in [
+            ('dob', 'DateField'), ('site', 'CharField'), ('age', 'IntegerField'),
+            ('delivery_date', 'DateField')]]
+        request = self.factory.get('/', dict(self.params, **{'search[value]': 'date'}))
+        payload = json.loads(datatable_response(request, rows, ['field_type']).content)
+
+        self.assertEqual((payload['draw'], payload['recordsTotal'], payload['recordsFiltered']),
+                         (3, 4, 2))
+        self.assertEqual([row['name'] for row in payload['data']], ['dob', 'delivery_date'])
+        self.assertIn({'label': 'DateField', 'value': 'DateField', 'total': 2, 'count': 2},
+                      payload['searchPanes']['options']['field_type'])
+
+    def test_ids_only_selects_every_matching_row(self):
+        rows = [{'name': f'field_{index}', 'field_type': 'CharField'} for index in range(5)]
+        rows.append({'name': 'empty_form', 'field_type': 'CharField', 'records_count': 0})
+        request = self.factory.get('/', dict(self.params, ids_only='1'))
+        payload = json.loads(datatable_response(request, rows).content)
+
+        self.assertNotIn('data', payload)
+        self.assertEqual(payload['names'],
+                         [f'field_{index}:CharField' for index in range(4, -1, -1)])
+
+    def test_repository_page(self):
+        request = self.factory.get('/', dict(self.params, start='1'))
+        with tempfile.TemporaryDirectory() as media_root:
+            os.makedirs(os.path.join(media_root, 'documents'))
+            for name in ['first.csv', 'second.csv', 'third.xlsx']:
+                open(os.path.join(media_root, 'documents', name), 'w').close()
+                ExportFile.objects.create(name=name, file=f'documents/{name}')
+            with override_settings(MEDIA_ROOT=media_root):
+                payload = json.loads(repository_datatable_response(request).content)
+
+        self.assertEqual(payload['recordsTotal'], 3)
+        self.assertEqual([row['name'] for row in payload['data']], ['second.csv', 'first.csv'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestDataTablesViews(TestCase):
+    """ The table endpoints return a DataTables page when sent `draw`. """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = django_apps.get_model(settings.AUTH_USER_MODEL).objects.create(
+            username='viewer')
+        cache.clear()
+        Projects.objects.create(name='tsepamo_2', verbose_name='Tsepamo 2')
+        for form_name in ['switcheripmstwo', 'personalidentifierstwo']:
+            InstrumentsMeta.objects.create(form_name=form_name, related_project='tsepamo_2')
+        SwitcherIpmsTwo.objects.create(record_id=1, cd4any='0')
+        self.params = {'draw': '1', 'start': '0', 'length': '1',
+                       'columns[0][data]': '', 'columns[1][data]': 'verbose_name',
+                       'order[0][column]': '1', 'order[0][dir]': 'asc'}
+
+    def get(self, view, **kwargs):
+        request = self.factory.get('/', self.params)
+        request.user = self.user
+        return json.loads(view(request, **kwargs).content)
+
+    def test_projects_endpoint(self):
+        payload = self.get(project_data_view, project_names='tsepamo_2')
+        self.assertEqual((payload['recordsTotal'], payload['recordsFiltered']), (1, 1))
+        self.assertEqual(payload['data'][0]['instruments'], 2)
+
+    def test_instruments_endpoint(self):
+        payload = self.get(form_data_view, project_names='tsepamo_2')
+        self.assertEqual(payload['recordsTotal'], 2)
+        self.assertEqual(len(payload['data']), 1)
+
+    def test_fields_endpoint(self):
+        payload = self.get(fetch_fields_view, instrument_names='switcheripmstwo')
+        self.assertGreater(payload['recordsTotal'], 1)
+        self.assertEqual(len(payload['data']), 1)
+
+
+class TestRepositoryDetails(TestCase):
+
+    def test_listing_costs_constant_queries(self):
+        User = django_apps.get_model(settings.AUTH_USER_MODEL)
+        for index in range(5):
+            User.objects.create(username=f'user{index}')
+            ExportFile.objects.create(name=f'export{index}.csv', file_size=2048,
+                                      file=f'documents/export{index}.csv',
+                                      user_created=f'user{index}')
+
+        with self.assertNumQueries(2):
+            records = get_repository_details()
+        self.assertEqual(records[0]['file_size'], '2.0 Kb')
+        self.assertEqual(records[0]['user_created'], 'user4')
+
+
+class TestFileDownloads(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.media_root = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.media_root.name, 'export.csv')
+        with open(self.file_path, 'wb') as f:
+            f.write(b'0123456789')
+
+    def tearDown(self):
+        self.media_root.cleanup()
+
+    def test_full_download_is_streamed(self):
+        response = file_download_response(self.factory.get('/'), self.file_path)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        response.close()
+
+    def test_range_request(self):
+        response = file_download_response(
+            self.factory.get('/', HTTP_RANGE='bytes=2-5'), self.file_path)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        response = file_download_response(
+            self.factory.get('/', HTTP_RANGE='bytes=20-'), self.file_path)
+        self.assertEqual(response.status_code, 416)
+
+    def test_suffix_range_of_empty_file(self):
+        open(self.file_path, 'wb').close()
+        response = file_download_response(
+            self.factory.get('/', HTTP_RANGE='bytes=-5'), self.file_path)
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */0')
+
+    def test_conditional_request(self):
+        etag = file_download_response(self.factory.get('/'), self.file_path)['ETag']
+        response = file_download_response(
+            self.factory.get('/', HTTP_IF_NONE_MATCH=etag), self.file_path)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(EXPORT_DOWNLOAD_MODE='x-accel-redirect')
+    def test_proxy_mode(self):
+        response = file_download_response(self.factory.get('/'), self.file_path)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/documents/export.csv')
+
+        file_path = os.path.join(self.media_root.name, 'Tsepamo "mothers" 2024 ü.csv')
+        open(file_path, 'wb').close()
+        response = file_download_response(self.factory.get('/'), file_path)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/documents/Tsepamo%20%22mothers%22%202024%20%C3%BC.csv')
+        self.assertEqual(response['Content-Disposition'],
+                         "attachment; filename*=utf-8''Tsepamo%20%22mothers%22%202024%20%C3%BC.csv")
+
+
+class TestAdaptiveChunkSize(TestCase):
+
+    def test_chunk_size_follows_target_latency(self):
+        sizer = AdaptiveChunkSize(initial=500, target_seconds=30)
+        self.assertEqual(sizer.observe(500, 5, 1024), 1000)
+        self.assertEqual(sizer.observe(1000, 60, 1024), 500)
+        self.assertEqual(sizer.timed_out(), 250)
+
+    def test_chunk_size_capped_by_payload_bytes(self):
+        sizer = AdaptiveChunkSize(initial=500, target_seconds=30, max_bytes=1000)
+        self.assertEqual(sizer.observe(500, 1, 2000), 250)
@@ -50,6 +50,7 @@ urlpatterns = [
     path('projects/exports/<str:project_names>/', render_export_reports_page, name='export-reports'),
 
     path('instruments/details/<str:project_names>/', form_data_view, name='instruments-details'),
+    path('instruments/fields/', fetch_fields_view, name='fetch-fields'),
     path('instruments/fields/<str:instrument_names>/', fetch_fields_view, name='fetch-fields'),
 
     path('fields/preview/', preview_data_view, name='preview-data'),
@@ -1,106 +1,147 @@
 import csv
-from datetime import datetime
-from decimal import Decimal
-from bson.decimal128 import Decimal128
+import uuid
 from django.apps import apps as django_apps
-from django.db.models import (DateTimeField, DateField, IntegerField,
-                              DecimalField)
+from .field_converters import (format_record, get_field_converter,
+                               get_model_converters)
+from .record_stats import increment_record_count
 import logging
 logger = logging.getLogger('celery_progress')
 
 
+class CSVColumnPlan:
+    """ Compiled once per CSV header, maps each column to the record key it
+        feeds. REDCap checkbox expansions (`field___code`) are grouped under
+        their field, and columns that feed no target model field are
+        dropped so rows are not mapped cell by cell.
+    """
+
+    def __init__(self, header, field_names=None):
+        self.plain_columns = []
+        self.choice_columns = {}
+        for index, column in enumerate(header):
+            key, _, code = column.partition('___')
+            if field_names is not None and key not in field_names:
+                continue
+            if code:
+                self.choice_columns.setdefault(key, []).append(
+                    (index, code.strip()))
+            else:
+                self.plain_columns.append((index, key))
+
+    def map_row(self, row):
+        # Short rows, e.g. trailing empty cells dropped, leave the rest None.
+        size = len(row)
+        record = {key: row[index] if index < size else None
+                  for index, key in self.plain_columns}
+        for key, options in self.choice_columns.items():
+            codes = [code for index, code in options if index < size and row[index] == '1']
+            record[key] = ', '.join(codes) if codes else None
+        return record
+
+
 class LoadCSVData:
-    def map_choice_data(self, key, value, record):
-        is_choice = key.split('___')
-        if len(is_choice) > 1:
-            key = is_choice[0]
-            value = is_choice[1].strip() if value == '1' else None
-            dict_value = record.setdefault(key, value)
-
-            if value and dict_value and dict_value != value:
-                list_value = dict_value.split(', ')
-                list_value.append(value)
-                record[key] = ', '.join(list_value)
-            return True
-        return False
-
-    def read_csv_data(self, csv_file):
-        data = []
-        with open(csv_file, 'r') as f:
-            reader = csv.DictReader(f)
+
+    def __init__(self, batch_size=1000, update_existing=False):
+        self.batch_size = batch_size
+        self.update_existing = update_existing
+
+    def read_csv_data(self, csv_file, field_names=None):
+        """ Lazily yields mapped records from a REDCap CSV export.
+            @param csv_file: path to the CSV file
+            @param field_names: fields of interest, other columns are skipped
+        """
+        with open(csv_file, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if not header:
+                return
+            column_plan = CSVColumnPlan(header, field_names)
             for row in reader:
-                record = {}
-                for key, value in row.items():
-                    if self.map_choice_data(key, value, record):
-                        continue
-                    record.update({f'{key}': value})
-                data.append(record)
-        return data
+                yield column_plan.map_row(row)
 
     def load_model_data(self, data, model_names):
+        loaders = []
         for model_name in model_names:
             print(f"Model: {model_name}")
             model_cls = django_apps.get_model(model_name)
-            model_fields = {
-                f'{field.name}': field for field in model_cls._meta.fields}
-
-            for record in data:
-                formatted_record = {}
-                for field_name, field in model_fields.items():
-                    value = record.get(field_name)
-                    if field_name == 'record_id':
-                        continue
-                    formatted_value = self.format_fields(field, value)
-                    formatted_record[field_name] = formatted_value
-                model_objs = model_cls.objects.filter(
-                    record_id=record.get('record_id'), )
-                if not model_objs:
-                    #     model_objs.update(**formatted_record)
-                    # else:
-                    create_record = formatted_record.copy()
-                    create_record.update(record_id=record.get('record_id'))
-                    print(f"Create Record {record.get('record_id')}")
-                    model_cls.objects.create(**create_record)
+            loaders.append(BulkModelLoader(
+                model_cls, batch_size=self.batch_size,
+                update_existing=self.update_existing))
+
+        for record in data:
+            for loader in loaders:
+                loader.add(record.get('record_id'),
+                           format_record(loader.converters, record))
+
+        for loader in loaders:
+            loader.flush()
+            increment_record_count(loader.model_cls, loader.created)
+            print(f'{loader.model_cls._meta.label}: created {loader.created}, '
+                  f'updated {loader.updated}')
+        return loaders
 
     def load_model_data_all(self, csv_files):
+        loaders = []
         for csv_file, model_names in csv_files:
-            data = self.read_csv_data(csv_file)
-            self.load_model_data(data, model_names)
+            field_names = {'record_id'}
+            for model_name in model_names:
+                model_cls = django_apps.get_model(model_name)
+                field_names.update(
+                    field.name for field in model_cls._meta.fields)
+            data = self.read_csv_data(csv_file, field_names)
+            loaders.extend(self.load_model_data(data, model_names))
+        return loaders
 
     def format_fields(self, field, value):
-        if isinstance(field, DateTimeField):
-            try:
-                value = datetime.strptime(
-                    value, '%Y-%m-%d %H:%M') if value else value
-            except ValueError:
-                try:
-                    value = datetime.strptime(
-                        value, '%Y-%d-%m %H:%M') if value else value
-                except ValueError:
-                    raise
-                except TypeError:
-                    pass
-            except TypeError:
-                pass
-        elif isinstance(field, DateField):
-            try:
-                value = datetime.strptime(
-                    value, '%Y-%m-%d').date() if value else value
-            except ValueError:
-                try:
-                    value = datetime.strptime(
-                        value, '%Y-%d-%m').date() if value else value
-                except ValueError:
-                    raise
-                except TypeError:
-                    pass
-            except TypeError:
-                pass
-        elif isinstance(field, IntegerField):
-            value = int(value) if value else value
-        elif isinstance(field, DecimalField):
-            if isinstance(value, Decimal128):
-                value = value.to_decimal()
-            value = Decimal(value) if value else value
-
-        return None if value == '' else value
+        return get_field_converter(field)(value)
+
+
+class BulkModelLoader:
+    """ Batches model rows for a single model, creating new records with
+        `bulk_create` and optionally updating existing ones. All existing
+        record ids are pre-fetched in one query, so each row costs no
+        lookup round trip.
+    """
+
+    def __init__(self, model_cls, batch_size=1000, update_existing=False):
+        self.model_cls = model_cls
+        self.batch_size = batch_size
+        self.update_existing = update_existing
+        self.converters = get_model_converters(model_cls)
+        self.record_id_field = model_cls._meta.get_field('record_id')
+        self.existing_ids = set(
+            model_cls.objects.values_list('record_id', flat=True))
+        self.pending = []
+        self.created = 0
+        self.updated = 0
+
+    def add(self, record_id, values):
+        """ Queue a row for creation, or update it in place when the record
+            already exists and `update_existing` is set.
+            @param record_id: record identifier of the row
+            @param values: formatted field values, excluding `record_id`
+        """
+        record_id = self.record_id_field.to_python(record_id)
+        if record_id is None:
+            return
+
+        if record_id in self.existing_ids:
+            if self.update_existing:
+                self.model_cls.objects.filter(
+                    record_id=record_id).update(**values)
+                self.updated += 1
+            return
+
+        self.existing_ids.add(record_id)
+        self.pending.append(
+            self.model_cls(id=uuid.uuid4(), record_id=record_id, **values))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.model_cls.objects.bulk_create(
+            self.pending, batch_size=self.batch_size)
+        self.created += len(self.pending)
+        self.pending = []
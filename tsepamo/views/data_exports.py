@@ -2,20 +2,29 @@ import os
 from django.apps import apps as django_apps
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
-from django.http.response import JsonResponse, HttpResponse
+from django.db.models import Q
+from django.http.response import JsonResponse
 from django.http import Http404
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 
+from .. import record_stats
 from ..models import Projects, InstrumentsMeta, ExportFile
 from ..tasks import generate_exports
 from ..export_utils import generate_model_data_dict
+from .datatables import DataTablesQuery, datatable_response, is_datatables_request
+from .file_downloads import file_download_response
 
 upload_folder = settings.MEDIA_ROOT
 
 exclude_fields = ['id', 'record_id', 'complete']
 
+# Repository table columns that can be ordered in the database.
+repository_order_fields = {'name': 'name',
+                           'date_created': 'date_created',
+                           'user_created': 'user_created'}
+
 
 @login_required(login_url='/')
 def render_export_reports_page(request, project_names):
@@ -87,6 +96,10 @@ def project_data_view(request, project_names=''):
     if request.method == 'GET':
         project_names = project_names.split(',') if project_names else []
         project_details = get_project_details(project_names)
+        if is_datatables_request(request):
+            return datatable_response(
+                request, project_details,
+                pane_columns=table_pane_columns(get_project_columns()))
         return JsonResponse(project_details, safe=False)
 
 
@@ -95,28 +108,55 @@ def form_data_view(request, project_names):
     if request.method == 'GET':
         project_names = project_names.split(',')
         form_details = get_forms_details(project_names)
+        if is_datatables_request(request):
+            return datatable_response(
+                request, form_details, pane_columns=table_pane_columns(get_forms_columns()))
         return JsonResponse(form_details, safe=False)
 
 
 @login_required(login_url='/')
-def fetch_fields_view(request, instrument_names):
-    if request.method == 'GET' and instrument_names:
-        instrument_names = instrument_names.split(',')
+def fetch_fields_view(request, instrument_names=''):
+    if request.method == 'GET':
+        instrument_names = instrument_names.split(',') if instrument_names else []
         fields_data = []
         for name in instrument_names:
             fields_data.extend(get_fields_by_name(name))
         # Filter out to get only unique fields details across the projects
         fields_data = [dict(field_data) for field_data in {tuple(data.items()) for data in fields_data}]
+        if is_datatables_request(request):
+            return datatable_response(
+                request, fields_data, pane_columns=table_pane_columns(get_fields_columns()))
         return JsonResponse(fields_data, safe=False)
 
 
 @login_required(login_url='/')
 def repository_data_view(request):
     if request.method == 'GET':
+        if is_datatables_request(request):
+            return repository_datatable_response(request)
         repository_data = get_repository_details()
         return JsonResponse(repository_data, safe=False)
 
 
+def repository_datatable_response(request):
+    """ Searches, orders and pages export files in the database, so only the
+        rows of the requested page are built.
+    """
+    query = DataTablesQuery(request)
+    queryset = ExportFile.objects.all()
+    records_total = queryset.count()
+    if query.search:
+        queryset = queryset.filter(
+            Q(name__icontains=query.search) | Q(user_created__icontains=query.search))
+    records_filtered = queryset.count() if query.search else records_total
+
+    order_by = [f"{'-' if descending else ''}{repository_order_fields[column]}"
+                for column, descending in query.order if column in repository_order_fields]
+    queryset = query.page(queryset.order_by(*(order_by or ['-date_created'])))
+    return query.response(
+        get_repository_details(queryset), records_total, records_filtered)
+
+
 @login_required(login_url='/')
 def project_fields(request, project_name):
     model_cls = django_apps.get_model('tsepamo', project_name)
@@ -173,19 +213,18 @@ def generate_data_dict_view(request, model_name):
 
 
 def download_export_file_view(request, file_name):
-    file_path = os.path.join(upload_folder, 'documents', file_name)
+    file_path = os.path.join(upload_folder, 'documents', os.path.basename(file_name))
     if os.path.exists(file_path):
-        with open(file_path, 'rb') as fh:
-            response = HttpResponse(fh.read(), content_type="application/octet-stream")
-            response['Content-Disposition'] = 'attachment; filename=' + os.path.basename(file_path)
-            return response
+        return file_download_response(request, file_path)
     else:
         raise Http404("File does not exist")
 
 
-def get_repository_details():
+def get_repository_details(repository_data=None):
     records = []
-    repository_data = ExportFile.objects.order_by('-date_created')
+    if repository_data is None:
+        repository_data = ExportFile.objects.order_by('-date_created')
+    repository_data = ExportFile.set_related_users(list(repository_data))
     for data in repository_data:
         records.append(
             {'name': data.name,
@@ -194,6 +233,7 @@ def get_repository_details():
              'user_created': data.user_badge,
              'file_status': data.export_status,
              'file_size': data.sizify,
+             'uncompressed_size': data.uncompressed_sizify,
              'actions': data.actions, })
     return records
 
@@ -265,6 +305,7 @@ def get_repository_columns():
             {'title': 'Created by', 'data': 'user_created', },
             {'title': 'Status', 'data': 'file_status', },
             {'title': 'Size', 'data': 'file_size', },
+            {'title': 'Uncompressed', 'data': 'uncompressed_size', },
             {'title': 'Actions', 'data': 'actions', }]
 
 
@@ -303,8 +344,15 @@ def get_projects_by_name(project_names=[]):
         return Projects.objects.all()
 
 
+def table_pane_columns(columns):
+    """ Data names of the columns custom_table.html shows search panes for,
+        the first two after the checkbox column.
+    """
+    return [column['data'] for column in columns[:2]]
+
+
 def get_record_count(model_cls):
-    return model_cls.objects.count()
+    return record_stats.get_record_count(model_cls)
 
 
 def get_latest_export_file():
@@ -0,0 +1,150 @@
+import re
+from collections import Counter
+from django.http.response import JsonResponse
+
+SEARCH_PANE_PARAM = re.compile(r'^searchPanes\[(?P<column>.+)\]\[\d+\]$')
+
+
+def is_datatables_request(request):
+    """ DataTables server-side processing sends a `draw` counter with every
+        request, plain ajax loads of the same url do not.
+    """
+    return 'draw' in request.GET
+
+
+class DataTablesQuery:
+    """ Parsed DataTables server-side processing parameters: paging
+        (`start`/`length`), the global search, column ordering and search
+        pane selections.
+    """
+
+    def __init__(self, request):
+        params = request.GET
+        self.draw = self.to_int(params.get('draw'), 0)
+        self.start = max(self.to_int(params.get('start'), 0), 0)
+        self.length = self.to_int(params.get('length'), 10)
+        self.search = params.get('search[value]', '').strip().lower()
+        self.ids_only = params.get('ids_only') == '1'
+
+        self.columns = []
+        self.searchable = []
+        index = 0
+        while f'columns[{index}][data]' in params:
+            data = params.get(f'columns[{index}][data]')
+            self.columns.append(data)
+            if data and params.get(f'columns[{index}][searchable]', 'true') == 'true':
+                self.searchable.append(data)
+            index += 1
+
+        self.order = []
+        index = 0
+        while f'order[{index}][column]' in params:
+            column = self.to_int(params.get(f'order[{index}][column]'), -1)
+            if 0 <= column < len(self.columns) and self.columns[column]:
+                self.order.append(
+                    (self.columns[column], params.get(f'order[{index}][dir]') == 'desc'))
+            index += 1
+
+        self.pane_filters = {}
+        for key in params:
+            match = SEARCH_PANE_PARAM.match(key)
+            if match:
+                self.pane_filters.setdefault(match.group('column'), set()).update(
+                    params.getlist(key))
+
+    @staticmethod
+    def to_int(value, default):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+
+    def page(self, rows):
+        if self.length < 0:
+            return rows[self.start:]
+        return rows[self.start:self.start + self.length]
+
+    def matches_search(self, row):
+        return any(self.search in str(row.get(column, '')).lower()
+                   for column in self.searchable)
+
+    def matches_panes(self, row):
+        return all(str(row.get(column)) in values
+                   for column, values in self.pane_filters.items())
+
+    def filter_rows(self, rows):
+        if self.search:
+            rows = [row for row in rows if self.matches_search(row)]
+        if self.pane_filters:
+            rows = [row for row in rows if self.matches_panes(row)]
+        return rows
+
+    @staticmethod
+    def sort_key(value):
+        if value is None:
+            return (2, 0, '')
+        if isinstance(value, (int, float)):
+            return (0, value, '')
+        return (1, 0, str(value).lower())
+
+    def order_rows(self, rows):
+        # Stable sorts applied last key first give a multi-column ordering.
+        for column, descending in reversed(self.order):
+            rows = sorted(rows, key=lambda row: self.sort_key(row.get(column)),
+                          reverse=descending)
+        return rows
+
+    def search_panes(self, rows, filtered_rows, pane_columns):
+        """ Per value totals over all rows and counts over the filtered rows,
+            the shape SearchPanes expects from a server-side table.
+        """
+        options = {}
+        for column in pane_columns:
+            totals = Counter(str(row.get(column)) for row in rows)
+            counts = Counter(str(row.get(column)) for row in filtered_rows)
+            options[column] = [{'label': value, 'value': value,
+                                'total': total, 'count': counts.get(value, 0)}
+                               for value, total in sorted(totals.items())]
+        return {'options': options}
+
+    def response(self, data, records_total, records_filtered, search_panes=None):
+        payload = {'draw': self.draw,
+                   'recordsTotal': records_total,
+                   'recordsFiltered': records_filtered,
+                   'data': data}
+        if search_panes is not None:
+            payload['searchPanes'] = search_panes
+        return JsonResponse(payload)
+
+
+def selection_name(row):
+    """ Name a selected row is tracked by in custom_table.html, fields carry
+        their type so date fields can be picked out.
+    """
+    if row.get('field_type') is not None:
+        return f"{row.get('name')}:{row['field_type']}"
+    return row.get('name')
+
+
+def is_selectable(row):
+    # Instruments and projects without records have their checkbox disabled.
+    return row.get('records') != 0 and row.get('records_count') != 0
+
+
+def datatable_response(request, rows, pane_columns=()):
+    """ Filters, orders and pages rows already built in memory, returning
+        only the requested page. With `ids_only=1` the names of every
+        matching selectable row are returned instead, for select all.
+        @param pane_columns: column data names to compute search panes for
+    """
+    query = DataTablesQuery(request)
+    filtered_rows = query.order_rows(query.filter_rows(rows))
+    if query.ids_only:
+        return JsonResponse(
+            {'draw': query.draw,
+             'names': [selection_name(row) for row in filtered_rows if is_selectable(row)]})
+    search_panes = None
+    if pane_columns:
+        search_panes = query.search_panes(rows, filtered_rows, pane_columns)
+    return query.response(
+        query.page(filtered_rows), len(rows), len(filtered_rows), search_panes)
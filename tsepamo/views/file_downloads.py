@@ -0,0 +1,133 @@
+import os
+import re
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import (content_disposition_header, http_date, parse_http_date_safe,
+                               quote_etag)
+
+RANGE_HEADER = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(file_path):
+    stat = os.stat(file_path)
+    return quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+
+
+def file_last_modified(file_path):
+    return os.stat(file_path).st_mtime
+
+
+def parse_range(range_header, size):
+    """ Parses a single `bytes=start-end` range.
+        @return: (start, end) inclusive, None to send the whole file, or
+            False when the range cannot be satisfied
+    """
+    match = RANGE_HEADER.match(range_header.strip())
+    if not match or not (match.group('start') or match.group('end')):
+        return None
+    if not size:
+        # No byte of an empty file can be addressed.
+        return False
+    if not match.group('start'):
+        # Suffix range, the last N bytes.
+        length = int(match.group('end'))
+        if not length:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(match.group('start'))
+    end = int(match.group('end')) if match.group('end') else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def if_range_matches(request, etag, last_modified):
+    """ A range is only honoured when `If-Range` is absent or still names
+        the current file.
+    """
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    if_range_date = parse_http_date_safe(if_range)
+    return if_range_date is not None and int(last_modified) <= if_range_date
+
+
+def iter_file_range(file_path, start, length):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def proxy_file_response(file_path, file_name, mode):
+    """ Hands the transfer to the front proxy, nginx serves the internal
+        location in `X-Accel-Redirect` and Apache the path in `X-Sendfile`,
+        both handling ranges and conditional requests themselves.
+    """
+    response = HttpResponse(content_type='application/octet-stream')
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'EXPORT_ACCEL_REDIRECT_PREFIX', '/protected/documents/')
+        response['X-Accel-Redirect'] = f'{prefix.rstrip("/")}/{quote(file_name)}'
+    else:
+        response['X-Sendfile'] = file_path
+    response['Content-Disposition'] = content_disposition_header(True, file_name)
+    return response
+
+
+def file_download_response(request, file_path):
+    """ Streams a file as an attachment, answering conditional requests with
+        304 and single range requests with 206 so resumed downloads fetch
+        only what is missing. With `EXPORT_DOWNLOAD_MODE` set to
+        `x-accel-redirect` or `x-sendfile` the proxy sends the file instead.
+    """
+    file_name = os.path.basename(file_path)
+    mode = getattr(settings, 'EXPORT_DOWNLOAD_MODE', None)
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        return proxy_file_response(file_path, file_name, mode)
+
+    size = os.path.getsize(file_path)
+    etag = file_etag(file_path)
+    last_modified = file_last_modified(file_path)
+
+    # 304 Not Modified or 412 Precondition Failed, without opening the file.
+    conditional = get_conditional_response(
+        request, etag=etag, last_modified=int(last_modified))
+    if conditional is not None:
+        conditional['ETag'] = etag
+        conditional['Last-Modified'] = http_date(last_modified)
+        return conditional
+
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if range_header and if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(range_header, size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            iter_file_range(file_path, start, end - start + 1),
+            status=206, content_type='application/octet-stream')
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Disposition'] = content_disposition_header(True, file_name)
+    else:
+        response = FileResponse(
+            open(file_path, 'rb'), as_attachment=True, filename=file_name,
+            content_type='application/octet-stream')
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response